@@ -0,0 +1,120 @@
+''' Benchmark building the regression dataset against the pivot and merge
+    implementation it replaced. The dataset can be scaled up by repeating every
+    input with a distinct args string.
+'''
+# std imports
+from argparse import ArgumentParser
+from time import perf_counter
+
+# tpl imports
+import pandas as pd
+
+# local imports
+from dataset import add_one_hot, get_regression_dataset
+from storage import read_dataset
+
+
+def pivot_regression_dataset(df, relative_to='min', include_app=False, run_size='all', round_targets=False,
+    include_runtime=None):
+    ''' The previous implementation of `get_regression_dataset`. Laghos only, and
+        `run_size` is either 'core' or 'all'.
+    '''
+    df = df.copy(deep=True)
+
+    if run_size == 'core':
+        df = df[df['ranks'] == 1]
+
+    if include_runtime in ['overhead', 'both']:
+        df['Overhead'] = (df['duration']*60.0) - df['REALTIME (sec)']
+
+    df = df[df['app'] == 'laghos']
+    df.drop(['exec', 'modules', 'spack_env', 'exec_path', 'events', 'path', 'duration'], axis=1, inplace=True)
+    df.set_index(['app', 'args', 'ranks', 'machine'], inplace=True)
+    df.dropna(axis=1, inplace=True)
+
+    if relative_to in ['min', 'max']:
+        rel = df['REALTIME (sec)'].groupby(['app', 'args', 'ranks'], observed=True).agg(relative_to)
+        df['Relative Time'] = df['REALTIME (sec)'] / rel
+    else:
+        rel = df.loc[:,:,:,relative_to]['REALTIME (sec)']
+        df['Relative Time'] = df['REALTIME (sec)'] / rel
+
+    pivot_df = pd.pivot(df.reset_index(), index=['app', 'args', 'ranks'], columns='machine', values='Relative Time')
+    pivot_df.columns = pivot_df.columns.astype(str) + ' Relative Time'
+    merged_df = df.merge(pivot_df, left_index=True, right_index=True, validate='1:1')
+
+    merged_df.reset_index(inplace=True)
+    df = add_one_hot(merged_df, 'machine')
+    df.drop('Relative Time', axis=1, inplace=True)
+    df.set_index(['app', 'args', 'ranks', 'machine'], inplace=True)
+
+    if include_runtime in ['overhead', None]:
+        df.drop('REALTIME (sec)', axis=1, inplace=True)
+
+    if include_app:
+        df.reset_index(inplace=True)
+        df = add_one_hot(df, 'app')
+        df.set_index(['app', 'args', 'ranks', 'machine'], inplace=True)
+
+    if round_targets:
+        target_cols = df.columns[df.columns.str.endswith('Relative Time')]
+        df[target_cols] = df[target_cols].round(2).astype('float64')
+
+    return df
+
+
+def scale_dataset(df, scale):
+    ''' Repeat `df` `scale` times, giving each copy of an input its own args.
+    '''
+    if scale == 1:
+        return df
+    copies = [df.assign(args=df['args'].astype(str) + ' #{}'.format(idx)) for idx in range(scale)]
+    combined = pd.concat(copies, ignore_index=True)
+    combined['args'] = combined['args'].astype('category')
+    return combined
+
+
+def best_time(func, repeat):
+    ''' Fastest of `repeat` calls to `func` and its last result. '''
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        times.append(perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset (.csv, .parquet or .feather)')
+    parser.add_argument('-s', '--scale', type=int, nargs='+', default=[1, 10, 100], help='times to repeat the inputs')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='timed runs of each builder')
+    parser.add_argument('--relative-to', type=str, default='min', help='min, max or a machine name')
+    args = parser.parse_args()
+
+    kwargs = {'relative_to': args.relative_to, 'include_app': False, 'round_targets': False,
+        'include_runtime': 'both'}
+    df = read_dataset(args.dataset)
+
+    print('{:>6} {:>9} {:>12} {:>12} {:>8} {:>12} {:>12}'.format('scale', 'rows', 'pivot (s)', 'grouped (s)',
+        'speedup', 'all apps (s)', 'node (s)'))
+    for scale in args.scale:
+        scaled = scale_dataset(df, scale)
+        pivot_time, expected = best_time(lambda: pivot_regression_dataset(scaled, run_size='core', **kwargs),
+            args.repeat)
+        grouped_time, result = best_time(lambda: get_regression_dataset(scaled, run_size='core', **kwargs),
+            args.repeat)
+        pd.testing.assert_frame_equal(result, expected)
+        pd.testing.assert_frame_equal(get_regression_dataset(scaled, run_size='all', **kwargs),
+            pivot_regression_dataset(scaled, run_size='all', **kwargs))
+
+        all_time, _ = best_time(lambda: get_regression_dataset(scaled, run_size='all', apps=None, **kwargs),
+            args.repeat)
+        node_time, _ = best_time(lambda: get_regression_dataset(scaled, run_size='node', apps=None, **kwargs),
+            args.repeat)
+        print('{:>6} {:>9} {:>12.4f} {:>12.4f} {:>7.2f}x {:>12.4f} {:>12.4f}'.format(scale, len(scaled), pivot_time,
+            grouped_time, pivot_time / grouped_time, all_time, node_time))
+
+
+if __name__ == '__main__':
+    main()
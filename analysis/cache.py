@@ -0,0 +1,200 @@
+''' On-disk caches keyed by the contents of dataset files. A cached value is only
+    reused while the file it was computed from has exactly the same bytes.
+'''
+# std imports
+from hashlib import sha1
+from os import getpid, listdir, makedirs, remove, replace, rmdir, scandir, utime, walk
+from os.path import isdir, join as path_join, relpath
+from socket import gethostname
+import pickle
+
+# tpl imports
+import numpy as np
+
+
+# bump this whenever the format of cached values changes, so old entries are
+# never mistaken for current ones
+CACHE_VERSION = 1
+CACHE_EXTENSION = '.pkl'
+HASH_CHUNK_BYTES = 1 << 20
+DEFAULT_FEATURE_CACHE_MB = 1024
+
+
+def _update_file(digest, fpath):
+    with open(fpath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+
+
+def file_hash(fpath):
+    ''' sha1 of the contents of `fpath`. A directory, such as a partitioned
+        dataset, is hashed by the relative paths and contents of all of its
+        files in sorted order.
+    '''
+    digest = sha1()
+    if not isdir(fpath):
+        _update_file(digest, fpath)
+        return digest.hexdigest()
+
+    fpaths = sorted(path_join(dirpath, name) for dirpath, _, names in walk(fpath) for name in names)
+    for file in fpaths:
+        name = relpath(file, fpath).encode('utf-8')
+        digest.update(b'%d:%s' % (len(name), name))
+        file_digest = sha1()
+        _update_file(file_digest, file)
+        digest.update(file_digest.digest())
+    return digest.hexdigest()
+
+
+def array_hash(*arrays):
+    ''' sha1 of the shapes, dtypes and contents of numpy `arrays`.
+    '''
+    digest = sha1()
+    for array in arrays:
+        digest.update('{}:{}'.format(array.shape, array.dtype).encode('utf-8'))
+        digest.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    ''' Cache key combining CACHE_VERSION and the reprs of `parts`.
+    '''
+    return sha1(':'.join(repr(part) for part in (CACHE_VERSION,) + parts).encode('utf-8')).hexdigest()
+
+
+def _write_pickle(obj, fpath):
+    # a temporary file per process, so processes on several nodes can fill a shared cache at once
+    tmp_fpath = '{}.{}-{}.tmp'.format(fpath, gethostname(), getpid())
+    with open(tmp_fpath, 'wb') as fp:
+        pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(tmp_fpath, fpath)
+
+
+class NormalizedCache:
+    ''' Cache of normalized per (system, app) datasets in `cachedir`. Entries are
+        stored as "cachedir/<system>/<app>/<key>.pkl" where the key hashes the
+        source file contents, the normalization rules and CACHE_VERSION. Each
+        system and app keeps a single entry; `evict` removes the rest.
+    '''
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(fpath, rules_version):
+        ''' Cache key of the dataset at `fpath` normalized with rules hashing to `rules_version`.
+        '''
+        return make_key(file_hash(fpath), rules_version)
+
+    def _path(self, system, app, key):
+        return path_join(self.cachedir, system, app, key + CACHE_EXTENSION)
+
+    def get(self, system, app, key):
+        ''' The cached frame for `key` or None if there is none.
+        '''
+        try:
+            with open(self._path(system, app, key), 'rb') as fp:
+                df = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return df
+
+    def put(self, system, app, key, df):
+        makedirs(path_join(self.cachedir, system, app), exist_ok=True)
+        _write_pickle(df, self._path(system, app, key))
+
+    def evict(self, keep):
+        ''' Remove every entry except the {(system, app): key} in `keep`. This drops
+            entries for old versions of a dataset and for datasets that are gone.
+            Returns the number of entries removed.
+        '''
+        if not isdir(self.cachedir):
+            return 0
+
+        num_removed = 0
+        for system in listdir(self.cachedir):
+            if not isdir(path_join(self.cachedir, system)):
+                continue
+            for app in listdir(path_join(self.cachedir, system)):
+                appdir = path_join(self.cachedir, system, app)
+                for fname in listdir(appdir):
+                    if fname != keep.get((system, app), '') + CACHE_EXTENSION:
+                        remove(path_join(appdir, fname))
+                        num_removed += 1
+                if not listdir(appdir):
+                    rmdir(appdir)
+            if not listdir(path_join(self.cachedir, system)):
+                rmdir(path_join(self.cachedir, system))
+        return num_removed
+
+
+class FeatureCache:
+    ''' Size bounded LRU cache of datasets built for training, stored as
+        "cachedir/<key>.pkl". Reading an entry marks it as recently used and
+        adding one evicts the least recently used entries until the cache holds
+        at most `max_mb` MB.
+    '''
+
+    def __init__(self, cachedir, max_mb=DEFAULT_FEATURE_CACHE_MB):
+        self.cachedir = cachedir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    @staticmethod
+    def key(fpath, *args):
+        ''' Cache key of a dataset built from the file at `fpath` with `args`.
+        '''
+        return make_key(file_hash(fpath), *args)
+
+    def _path(self, key):
+        return path_join(self.cachedir, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        ''' The cached value for `key` or None if there is none.
+        '''
+        fpath = self._path(key)
+        try:
+            with open(fpath, 'rb') as fp:
+                value = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            utime(fpath)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        makedirs(self.cachedir, exist_ok=True)
+        _write_pickle(value, self._path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        ''' Remove the least recently used entries, other than `keep`, until the
+            cache fits in its size limit. Several processes may share the cache, so
+            entries that another process removed meanwhile are skipped. Returns the
+            number of entries removed.
+        '''
+        entries = []
+        for entry in scandir(self.cachedir):
+            if entry.name.endswith(CACHE_EXTENSION):
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime_ns, info.st_size, entry.name))
+        entries.sort(reverse=True)
+
+        num_removed, total_bytes = 0, 0
+        for _, nbytes, fname in entries:
+            total_bytes += nbytes
+            if total_bytes > self.max_bytes and fname[:-len(CACHE_EXTENSION)] != keep:
+                try:
+                    remove(path_join(self.cachedir, fname))
+                    num_removed += 1
+                except FileNotFoundError:
+                    pass
+                total_bytes -= nbytes
+        return num_removed
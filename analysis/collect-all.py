@@ -0,0 +1,63 @@
+''' Collect, normalize and combine the runs of every system and app in one pass.
+    This is the same as running collect-dataset.py on each "<root>/<system>/<app>"
+    tree and then combine-datasets.py, but with a single filesystem traversal.
+'''
+# std imports
+from argparse import ArgumentParser
+
+# tpl imports
+import pandas as pd
+
+# local imports
+from failures import FailureCatalog
+from collection import iter_tree_results
+from normalization import DEFAULT_RULES, load_rules, normalize_columns, normalize_inputs
+from storage import apply_dtypes, unify_categories, write_dataset
+
+
+def parse_args():
+    ''' Parses input arguments
+    '''
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--root', type=str, required=True, help='root of data directories')
+    parser.add_argument('-o', '--output', type=str, help='output dataset file path (.csv, .parquet or .feather)')
+    parser.add_argument('--clean', action='store_true', help='cleans up data directories ' +
+        '(removes invalid dirs)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to validate ' +
+        'and parse run directories')
+    parser.add_argument('--catalog', type=str, help='sqlite catalog of failed runs. Known failures are ' +
+        'skipped and new ones are recorded')
+    parser.add_argument('--rules', type=str, help='json file of normalization rules to use instead of the defaults')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    catalog = FailureCatalog(args.catalog) if args.catalog else None
+    rules = load_rules(args.rules) if args.rules else DEFAULT_RULES
+
+    dataframes = []
+    for system, app, df in iter_tree_results(args.root, clean=args.clean, jobs=args.jobs, catalog=catalog):
+        normalize_columns(df, rules)
+        normalize_inputs(df, rules)
+        apply_dtypes(df)
+        dataframes.append(df)
+        print('Collected dataset for \'{}\' on \'{}\'.'.format(app, system))
+
+    if not dataframes:
+        print('Found no \'<system>/<app>\' run trees under \'{}\'.'.format(args.root))
+        return
+
+    unify_categories(dataframes)
+    combined = pd.concat(dataframes, ignore_index=True)
+    print('Final dataset has {} rows and {} columns.'.format(combined.shape[0], combined.shape[1]))
+
+    if args.output:
+        write_dataset(combined, args.output)
+        print('Wrote combined dataset to \'{}\'.'.format(args.output))
+
+
+
+if __name__ == '__main__':
+    main()
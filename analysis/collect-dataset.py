@@ -4,15 +4,14 @@ date: June 2022
 '''
 # std imports
 from argparse import ArgumentParser
-from os import listdir
-from os.path import exists, isdir, join as path_join
-from shutil import rmtree
-import json
-from csv import QUOTE_NONNUMERIC
+from os.path import getsize, join as path_join
 
-# tpl imports
-from alive_progress import alive_it
-import pandas as pd
+# local imports
+from failures import FailureCatalog
+from profiling import PipelineProfiler, stage
+from collection import collect_streaming, get_run_results
+from manifest import MANIFEST_NAME
+from storage import write_dataset
 
 
 def parse_args():
@@ -21,194 +20,68 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument('-c', '--configuration', help='json file containing run configuration')
     parser.add_argument('--root', type=str, required=True, help='root to data set')
-    parser.add_argument('-o', '--output', type=str, help='output dataset file path')
+    parser.add_argument('-o', '--output', type=str, help='output dataset file path (.csv, .parquet or .feather)')
     parser.add_argument('--clean', action='store_true', help='cleans up data directory ' +
         '(removes invalid dirs)')
-    return parser.parse_args()
-
-
-def get_input_to_failed_job(dirpath):
-    ''' Recover the input arguments to a failed run. The 'results.json' file may
-        be ill-formatted.
-    '''
-    input_args = ''
-    with open(path_join(dirpath, 'results.json'), 'r') as fp:
-        try:
-            obj = json.load(fp)
-            input_args = obj['args']
-        except json.JSONDecodeError:
-            start_str = '\t"args": "'
-            fp.seek(0)
-            for line in fp:
-                if line.startswith(start_str):
-                    input_args = line[len(start_str):-3]
-                    break
-    return input_args
-
-
-def check_seg_fault(dirpath):
-    ''' When a run segfaults it creates a huge stderr output. Identify these and denote
-        what input led to segfault.
-    '''
-    segfault = False
-    with open(path_join(dirpath, 'std.err'), 'r') as fp:
-        for line in fp:
-            if 'Segmentation fault (signal 11)' in line:
-                segfault = True
-                break
-        
-    if segfault:
-        input_args = get_input_to_failed_job(dirpath)
-        print('Profile at \'{}\' segfaulted on input \'{}\'.'.format(dirpath.split('/')[-1], input_args))
-    
-    return segfault
-    
-
-def check_time_limit(dirpath):
-    ''' Check if job failed cause of time limit.
-    '''
-    ran_out_of_time = False
-    with open(path_join(dirpath, 'std.err'), 'r') as fp:
-        for line in fp:
-            if line.strip().endswith('DUE TO TIME LIMIT ***'):
-                ran_out_of_time = True
-                break
-
-        if ran_out_of_time:
-            input_args = get_input_to_failed_job(dirpath)
-            print('Profile at \'{}\' ran out of time on input \'{}\'.'.format(
-                dirpath.split('/')[-1], input_args
-            ))
-
-    return ran_out_of_time
-
-
-def run_errored_cleanly(dirpath):
-    ''' Check if the run errored cleanly.
-    '''
-    errored = False
-    with open(path_join(dirpath, 'std.err'), 'r') as fp:
-        for line in fp:
-            if line.strip() == 'FileNotFoundError: [Errno 2] No such file or directory: \'hpctoolkit-database/experiment.xml\'':
-                errored = True
-                break
-    
-    with open(path_join(dirpath, 'std.out'), 'r') as fp:
-        for line in fp:
-            # hpctoolkit build-db error
-            if line.strip().startswith('ERROR: [Diagnostics::FatalException] Error:'):
-                errored = True
-                break
-        
-    if errored:
-        input_args = get_input_to_failed_job(dirpath)
-        print('Profile at \'{}\' errored during run on input \'{}\'.'.format(
-            dirpath.split('/')[-1], input_args
-        ))
-    return errored
-            
-
-def is_valid_results_dir(dirpath):
-    ''' Checks if `dirpath` points to a valid results directory. i.e. does it 
-        exist and is the data in the correct format.
-    '''
-    if not isdir(dirpath):
-        return False
-
-    files = listdir(dirpath)
-    EXPECTED = ['std.out', 'std.err', 'results.json']
-    UNEXPECTED = ['hpctoolkit-database', 'hpctoolkit-measurements']
-    #UNEXPECTED = ['hpctoolkit-measurements']
-
-    has_all_files = all([fname in files for fname in EXPECTED])
-    if not has_all_files:   # early exit
-        return False
-
-    has_no_invalid_files = all([fname not in files for fname in UNEXPECTED])
-    if not has_no_invalid_files:   # early exit
-        input_args = get_input_to_failed_job(dirpath)
-        print(f'Profile at \'{dirpath.split("/")[-1]}\' ran out of time on input \'{input_args}\'.')
-        return False
-
-    has_valid_results_json = True
-    try:
-        json.load(open(path_join(dirpath, 'results.json')))
-    except ValueError:
-        has_valid_results_json = False
-    if not has_valid_results_json:   # early exit
-        return False
-
-    did_not_segfault = not check_seg_fault(dirpath)
-    if not did_not_segfault:   # early exit
-        return False
-
-    did_not_run_out_of_time = not check_time_limit(dirpath)
-    if not did_not_run_out_of_time:   # early exit
-        return False
-
-    did_not_error_cleanly = not run_errored_cleanly(dirpath)
-    if not did_not_error_cleanly:   # early exit
-        return False
-
-    return all([has_all_files, has_no_invalid_files, has_valid_results_json, did_not_segfault, did_not_run_out_of_time,
-        did_not_error_cleanly])
-
-
-def get_run_results(root, clean=False):
-    ''' Collect all the run directories within a root. Returns a dataframe with 
-        the corresponding results.
-    '''
-    subdirs = listdir(root)
-    FILES_TO_IGNORE = ['data.csv']
-
-    valid_count = 0
-    total_count = sum([isdir(path_join(root, x)) for x in subdirs])
-    results_data = []
-    for subdir in alive_it(subdirs, bar='classic', spinner='classic'):
-        if subdir in FILES_TO_IGNORE or len(listdir(path_join(root, subdir))) == 0:
-            continue
-        
-        #check validity of data directory
-        is_valid = is_valid_results_dir(path_join(root, subdir))
-        if not is_valid:
-            print('\'{}\' is an invalid results directory.'.format(subdir))
-            if clean and isdir(path_join(root, subdir)):
-                print('Removing \'{}\'...'.format(path_join(root, subdir)))
-                rmtree(path_join(root, subdir))
-            continue
-
-        valid_count += 1
-        result = {}
-
-        with open(path_join(root, subdir, 'results.json')) as fp:
-            tmp_result = json.load(fp)
-            result.update(tmp_result)
-        
-        results_data.append(result)
-
-    df = pd.DataFrame(results_data)
-    df['duration'] = pd.to_numeric(df['duration']) # string -> number
-
-    print('Parsed {} directories. {} / {} valid.'.format(total_count, valid_count, total_count))
-
-    # group rows with the same column
-    # agg columns: counters (...), events (cat), path (list), duration (avg)
-    group_columns = ['machine', 'app', 'exec', 'args', 'ranks', 'modules', 'spack_env', 'exec_path']
-    agg_funcs = {'events': ' '.join, 'path': list, 'duration': 'min'}
-    agg_funcs.update( dict.fromkeys(df.columns[df.dtypes.eq('float64')], 'first') )
-    group_df = df.groupby(by=group_columns).agg(agg_funcs).reset_index()
-
-    return group_df
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to validate ' +
+        'and parse run directories')
+    parser.add_argument('--incremental', action='store_true', help='only re-examine run directories that are ' +
+        'new or changed since the last collection')
+    parser.add_argument('--manifest', type=str, help='manifest file used by --incremental ' +
+        '(default: <root>/{})'.format(MANIFEST_NAME))
+    parser.add_argument('--stream', action='store_true', help='write records to disk as they are parsed and ' +
+        'group them out of core, so memory use does not grow with the number of run directories')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='records held in memory at once ' +
+        'with --stream')
+    parser.add_argument('--partitions', type=int, default=16, help='number of hash partitions used to ' +
+        'group records with --stream')
+    parser.add_argument('--spill-dir', type=str, help='directory for --stream temporary files ' +
+        '(default: system temp dir)')
+    parser.add_argument('--catalog', type=str, help='sqlite catalog of failed runs. Known failures are ' +
+        'skipped and new ones are recorded')
+    parser.add_argument('--profile', type=str, metavar='PREFIX', help='profile the collection and write ' +
+        'the report to PREFIX.json and a Chrome trace to PREFIX.trace.json')
+    parser.add_argument('--profile-top', type=int, default=10, help='number of slowest run directories ' +
+        'named in the profile')
+    args = parser.parse_args()
+    if args.stream and args.incremental:
+        # the manifest holds the parsed record of every run directory in memory
+        parser.error('--stream cannot be combined with --incremental, as the manifest would hold every record ' +
+            'in memory')
+    return args
 
 
 def main():
     args = parse_args()
 
-    df = get_run_results(args.root, clean=args.clean)
-
-    if args.output:
-        df.to_csv(args.output, index=False, quoting=QUOTE_NONNUMERIC)
-        print('Wrote dataset with {} rows.'.format(df.shape[0]))
+    manifest_path = None
+    if args.incremental:
+        manifest_path = args.manifest or path_join(args.root, MANIFEST_NAME)
+
+    catalog = FailureCatalog(args.catalog) if args.catalog else None
+    profiler = PipelineProfiler() if args.profile else None
+
+    if args.stream:
+        if not args.output:
+            raise ValueError('--stream requires an --output file.')
+        num_rows = collect_streaming(args.root, args.output, clean=args.clean, jobs=args.jobs,
+            chunk_size=args.chunk_size, partitions=args.partitions, spill_dir=args.spill_dir, catalog=catalog,
+            profiler=profiler)
+        print('Wrote dataset with {} rows.'.format(num_rows))
+    else:
+        df = get_run_results(args.root, clean=args.clean, jobs=args.jobs, manifest_path=manifest_path,
+            catalog=catalog, profiler=profiler)
+
+        if args.output:
+            with stage(profiler, 'write') as stage_info:
+                write_dataset(df, args.output)
+                stage_info['bytes'] = getsize(args.output)
+            print('Wrote dataset with {} rows.'.format(df.shape[0]))
+
+    if profiler is not None:
+        report = profiler.write(args.profile, top=args.profile_top)
+        profiler.print_summary(report)
+        print('Wrote profile to \'{0}.json\' and \'{0}.trace.json\'.'.format(args.profile))
 
 
 
@@ -0,0 +1,428 @@
+''' Collect the results of profiling runs from their run directories. Shared by
+    collect-dataset.py and collect-all.py.
+'''
+# std imports
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice, repeat
+from os import listdir, scandir
+from os.path import abspath, basename, dirname, exists, isdir, join as path_join
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from zlib import crc32
+import heapq
+import json
+import pickle
+
+# tpl imports
+from alive_progress import alive_it
+import pandas as pd
+
+# local imports
+from failures import CATALOGED_KINDS, check_results_dir, describe_failure
+from profiling import call_profiled, stage, timed
+from manifest import MANIFEST_NAME, entry_to_examined, fingerprint_run_dir, load_manifest, make_entry, \
+    save_manifest
+from storage import DATASET_EXTENSIONS, DatasetWriter
+
+
+FILES_TO_IGNORE = ['data' + ext for ext in DATASET_EXTENSIONS] + [MANIFEST_NAME]
+
+
+def list_run_dirs(root):
+    ''' Names of the entries in `root` and whether each is a directory. This
+        comes from a single directory scan without a stat per entry.
+    '''
+    with scandir(root) as entries:
+        return [(entry.name, entry.is_dir()) for entry in entries]
+
+
+def examine_run_dir(root, subdir, is_dir=None):
+    ''' Validate and parse a single run directory. This is the unit of work handed
+        to the process pool. `is_dir` can be passed if it is already known from
+        listing `root`.
+        Returns:
+            (is_dir, status, result, failure) where status is one of 'skipped',
+            'invalid' or 'valid', result is the parsed results.json dict for valid
+            runs and failure is the RunFailure for invalid ones.
+    '''
+    dirpath = path_join(root, subdir)
+    if is_dir is None:
+        is_dir = isdir(dirpath)
+    if subdir in FILES_TO_IGNORE or not is_dir:
+        return is_dir, 'skipped', None, None
+
+    with timed('list'):
+        files = listdir(dirpath)
+    if len(files) == 0:
+        return is_dir, 'skipped', None, None
+
+    result, failure = check_results_dir(dirpath, files=files)
+    if failure is not None:
+        return is_dir, 'invalid', None, failure
+    return is_dir, 'valid', result, None
+
+
+def examine_run_dir_incremental(root, subdir, entry, is_dir=None):
+    ''' Like `examine_run_dir`, but reuses the manifest `entry` for the directory
+        if its fingerprint has not changed.
+        Returns:
+            (fingerprint, examined, reused) where examined is the tuple returned by
+            `examine_run_dir`.
+    '''
+    if subdir in FILES_TO_IGNORE:
+        return None, examine_run_dir(root, subdir, is_dir=is_dir), False
+
+    with timed('fingerprint'):
+        fingerprint = fingerprint_run_dir(path_join(root, subdir))
+    if entry is not None and entry['fingerprint'] == fingerprint:
+        return fingerprint, entry_to_examined(entry), True
+    return fingerprint, examine_run_dir(root, subdir, is_dir=is_dir), False
+
+
+def report_invalid_dir(root, subdir, failure, clean=False):
+    ''' Print why `root/subdir` is invalid and remove it if `clean`. Returns
+        True if the directory was removed.
+    '''
+    message = describe_failure(subdir, failure)
+    if message:
+        print(message)
+    print('\'{}\' is an invalid results directory.'.format(subdir))
+    if clean and isdir(path_join(root, subdir)):
+        print('Removing \'{}\'...'.format(path_join(root, subdir)))
+        rmtree(path_join(root, subdir))
+        return True
+    return False
+
+
+def tree_names(root):
+    ''' The (system, app) of a "<system>/<app>" run tree.
+    '''
+    root = abspath(root)
+    return basename(dirname(root)), basename(root)
+
+
+class CatalogUpdater:
+    ''' Collects the catalog changes for one run tree as its directories are
+        examined and writes them in one transaction.
+    '''
+
+    def __init__(self, catalog, root):
+        self.catalog, self.root = catalog, abspath(root)
+        self.known = catalog.entries(self.root) if catalog is not None else {}
+        self.failed, self.recovered = [], []
+        self.skipped_count = 0
+
+    def cached_entry(self, subdir):
+        ''' Manifest style entry for a known failure, or None.
+        '''
+        if subdir not in self.known:
+            return None
+        fingerprint, failure = self.known[subdir]
+        return make_entry(fingerprint, True, 'invalid', None, failure)
+
+    def update(self, subdir, fingerprint, status, failure, reused):
+        ''' Record the outcome of examining `subdir`. Failures reused from the
+            manifest are only skipped if the catalog already has them, so ones
+            found before the catalog existed are still added.
+        '''
+        if reused and subdir in self.known:
+            self.skipped_count += (status == 'invalid')
+        elif status == 'invalid' and failure.kind in CATALOGED_KINDS:
+            self.failed.append((subdir, fingerprint, failure))
+        elif subdir in self.known:
+            self.recovered.append(subdir)
+
+    def commit(self):
+        if self.catalog is None:
+            return
+        self.catalog.record(self.root, *tree_names(self.root), self.failed)
+        self.catalog.forget(self.root, self.recovered)
+        print('Skipped {} known failed directories. Cataloged {} new failures in \'{}\'.'.format(
+            self.skipped_count, len(self.failed), self.root))
+
+
+def _pool_map(executor, num_tasks, jobs):
+    if executor is None:
+        return map
+    return partial(executor.map, chunksize=max(1, num_tasks // (jobs * 16)))
+
+
+def _profiled(func, profiler):
+    return func if profiler is None else partial(call_profiled, func)
+
+
+def iter_run_results(root, clean=False, jobs=1, manifest_path=None, catalog=None, profiler=None):
+    ''' Yield the results of each valid run directory within a root as they are
+        parsed. If `jobs` > 1, then directories are examined by a pool of `jobs`
+        processes. Results are still consumed in listing order, so the output and
+        reporting are the same as a serial run. If `manifest_path` is given, then
+        only directories that are new or changed since the manifest was written are
+        examined and the manifest is updated. If a FailureCatalog `catalog` is
+        given, then known failed directories that have not changed are skipped and
+        new failures are added to it. If a PipelineProfiler `profiler` is given,
+        then the listing and examining stages and every directory are profiled.
+    '''
+    with stage(profiler, 'list'):
+        entries = list_run_dirs(root)
+    subdirs, dir_flags = [name for name, _ in entries], [is_dir for _, is_dir in entries]
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    new_manifest, reused_count = {}, 0
+    catalog_updater = CatalogUpdater(catalog, root)
+
+    valid_count, total_count = 0, 0
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor, \
+        stage(profiler, 'examine') as stage_info:
+        map_func = _pool_map(executor, len(subdirs), jobs)
+        if manifest is None and catalog is None:
+            examined = map_func(_profiled(examine_run_dir, profiler), repeat(root), subdirs, dir_flags)
+        else:
+            cached = [catalog_updater.cached_entry(subdir) or (manifest or {}).get(subdir) for subdir in subdirs]
+            examined = map_func(_profiled(examine_run_dir_incremental, profiler), repeat(root), subdirs, cached,
+                dir_flags)
+
+        for subdir, item in alive_it(zip(subdirs, examined), total=len(subdirs), bar='classic', spinner='classic'):
+            if profiler is not None:
+                item, steps, pid, peak_rss_mb = item
+                stage_info['bytes'] += profiler.add_dir(subdir, steps, pid, peak_rss_mb)
+
+            if manifest is not None or catalog is not None:
+                fingerprint, item, reused = item
+                reused_count += reused
+                if fingerprint is not None:
+                    new_manifest[subdir] = make_entry(fingerprint, *item)
+                    catalog_updater.update(subdir, fingerprint, item[1], item[3], reused)
+
+            is_dir, status, result, failure = item
+            total_count += is_dir
+            if status == 'skipped':
+                continue
+
+            #check validity of data directory
+            if status == 'invalid':
+                if report_invalid_dir(root, subdir, failure, clean=clean):
+                    new_manifest.pop(subdir, None)
+                continue
+
+            valid_count += 1
+            yield result
+
+    catalog_updater.commit()
+    if manifest is not None:
+        save_manifest(manifest_path, new_manifest)
+        print('Reused {} / {} directories from manifest \'{}\'.'.format(reused_count, len(new_manifest),
+            manifest_path))
+
+    print('Parsed {} directories. {} / {} valid.'.format(total_count, valid_count, total_count))
+
+
+GROUP_COLUMNS = ['machine', 'app', 'exec', 'args', 'ranks', 'modules', 'spack_env', 'exec_path']
+
+
+def group_run_results(df):
+    ''' Group rows of `df` that come from the same run configuration.
+    '''
+    df['duration'] = pd.to_numeric(df['duration']) # string -> number
+
+    # group rows with the same column
+    # agg columns: counters (...), events (cat), path (list), duration (avg)
+    agg_funcs = {'events': ' '.join, 'path': list, 'duration': 'min'}
+    agg_funcs.update( dict.fromkeys(df.columns[df.dtypes.eq('float64')], 'first') )
+    return df.groupby(by=GROUP_COLUMNS).agg(agg_funcs).reset_index()
+
+
+def get_run_results(root, clean=False, jobs=1, manifest_path=None, catalog=None, profiler=None):
+    ''' Collect all the run directories within a root. Returns a dataframe with 
+        the corresponding results. See `iter_run_results` for the arguments.
+    '''
+    results_data = list(iter_run_results(root, clean=clean, jobs=jobs, manifest_path=manifest_path, catalog=catalog,
+        profiler=profiler))
+    with stage(profiler, 'dataframe'):
+        df = pd.DataFrame(results_data)
+        del results_data
+    with stage(profiler, 'group'):
+        return group_run_results(df)
+
+
+def find_run_trees(datadir):
+    ''' Find each "datadir/<system>/<app>" run tree. Returns a sorted list of
+        (system, app, path).
+    '''
+    trees = []
+    with scandir(datadir) as systems:
+        for system in systems:
+            if not system.is_dir():
+                continue
+            with scandir(system.path) as apps:
+                trees.extend((system.name, app.name, app.path) for app in apps if app.is_dir())
+    return sorted(trees)
+
+
+def iter_tree_results(datadir, clean=False, jobs=1, catalog=None):
+    ''' Collect every run tree under `datadir` in one traversal. The run
+        directories of all the trees are listed up front and examined by a single
+        pool of `jobs` processes, so the trees are processed in parallel. Yields
+        (system, app, group_df) for each tree with any valid runs, in sorted order.
+        Each group_df is the same as `get_run_results` on that tree. `catalog` is
+        used as in `iter_run_results`.
+    '''
+    trees = find_run_trees(datadir)
+    catalog_updaters = {root: CatalogUpdater(catalog, root) for _, _, root in trees}
+    owners, roots, subdirs, dir_flags = [], [], [], []
+    for system, app, root in trees:
+        for name, is_dir in list_run_dirs(root):
+            owners.append((system, app))
+            roots.append(root)
+            subdirs.append(name)
+            dir_flags.append(is_dir)
+
+    valid_count, total_count = 0, 0
+    results_data = {(system, app): [] for system, app, _ in trees}
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as executor:
+        map_func = _pool_map(executor, len(subdirs), jobs)
+        if catalog is None:
+            examined = map_func(examine_run_dir, roots, subdirs, dir_flags)
+        else:
+            cached = [catalog_updaters[root].cached_entry(subdir) for root, subdir in zip(roots, subdirs)]
+            examined = map_func(examine_run_dir_incremental, roots, subdirs, cached, dir_flags)
+
+        for owner, root, subdir, item in alive_it(zip(owners, roots, subdirs, examined), total=len(subdirs),
+            bar='classic', spinner='classic'):
+            if catalog is not None:
+                fingerprint, item, reused = item
+                if fingerprint is not None:
+                    catalog_updaters[root].update(subdir, fingerprint, item[1], item[3], reused)
+
+            is_dir, status, result, failure = item
+            total_count += is_dir
+            if status == 'invalid':
+                report_invalid_dir(root, subdir, failure, clean=clean)
+            elif status == 'valid':
+                valid_count += 1
+                results_data[owner].append(result)
+
+    for catalog_updater in catalog_updaters.values():
+        catalog_updater.commit()
+    print('Parsed {} directories in {} trees. {} / {} valid.'.format(total_count, len(trees), valid_count,
+        total_count))
+
+    for system, app, _ in trees:
+        if results_data[(system, app)]:
+            yield system, app, group_run_results(pd.DataFrame(results_data.pop((system, app))))
+
+
+class RecordSpiller:
+    ''' Hash-partitions run records on their group columns into JSON lines files,
+        so that every group can be aggregated from a single partition. At most
+        `chunk_size` records are buffered in memory. The union of the record
+        columns and which of them pandas would read as float64 are tracked, so that
+        each partition is typed the same as the whole dataset would have been.
+    '''
+
+    def __init__(self, spill_dir, partitions, chunk_size):
+        self.fpaths = [path_join(spill_dir, 'records-{}.jsonl'.format(idx)) for idx in range(partitions)]
+        self.chunk_size = chunk_size
+        self.buffers = [[] for _ in range(partitions)]
+        self.buffered = 0
+        self.count = 0
+        self.columns = {}   # column -> number of records with a value; insertion ordered
+        self.non_float_columns, self.float_valued_columns = set(), set()
+
+    def add(self, record):
+        for col, val in record.items():
+            if col not in self.columns:
+                self.columns[col] = 0
+            if val is None:
+                continue
+            self.columns[col] += 1
+            if isinstance(val, float):
+                self.float_valued_columns.add(col)
+            elif isinstance(val, bool) or not isinstance(val, int):
+                self.non_float_columns.add(col)
+
+        key = json.dumps([record.get(col) for col in GROUP_COLUMNS])
+        self.buffers[crc32(key.encode()) % len(self.buffers)].append(json.dumps(record))
+        self.count += 1
+        self.buffered += 1
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for fpath, buffer in zip(self.fpaths, self.buffers):
+            if buffer:
+                with open(fpath, 'a') as fp:
+                    fp.write('\n'.join(buffer) + '\n')
+                buffer.clear()
+        self.buffered = 0
+
+    def float_columns(self):
+        ''' Columns pandas reads as float64: numeric with at least one float or a
+            missing value.
+        '''
+        return [col for col, present in self.columns.items() if present > 0 and col not in self.non_float_columns
+            and (col in self.float_valued_columns or present < self.count)]
+
+    def iter_partitions(self):
+        ''' Yield each partition as a dataframe with the columns and float64
+            columns of the whole dataset.
+        '''
+        self.flush()
+        float_columns = self.float_columns()
+        for fpath in self.fpaths:
+            if not exists(fpath):
+                continue
+            with open(fpath, 'r') as fp:
+                df = pd.DataFrame([json.loads(line) for line in fp], columns=list(self.columns))
+            df = df.astype({col: 'float64' for col in float_columns})
+            non_float = [col for col in df.columns[df.dtypes.eq('float64')] if col not in float_columns]
+            yield df.astype({col: 'object' for col in non_float})
+
+
+def iter_spilled_rows(fpath):
+    ''' Yield rows as tuples from a file of pickled dataframe chunks.
+    '''
+    with open(fpath, 'rb') as fp:
+        while True:
+            try:
+                chunk = pickle.load(fp)
+            except EOFError:
+                return
+            yield from chunk.itertuples(index=False, name=None)
+
+
+def collect_streaming(root, output, clean=False, jobs=1, chunk_size=10000, partitions=16, spill_dir=None,
+    catalog=None, profiler=None):
+    ''' Collect the run directories within a root straight to the dataset file
+        `output` without holding every record in memory. Records are spilled to
+        `partitions` hash partitions, each partition is grouped on its own and the
+        sorted groups are merged into `output` in chunks of `chunk_size` rows. The
+        rows written are the same and in the same order as `get_run_results`.
+        There is no incremental mode, as its manifest keeps the parsed record of
+        every run directory in memory. Returns the number of rows written.
+    '''
+    with TemporaryDirectory(dir=spill_dir) as tmpdir:
+        spiller = RecordSpiller(tmpdir, partitions, chunk_size)
+        for result in iter_run_results(root, clean=clean, jobs=jobs, catalog=catalog, profiler=profiler):
+            spiller.add(result)
+
+        # group each partition and spill the sorted groups in chunks
+        grouped_fpaths, columns = [], None
+        with stage(profiler, 'group'):
+            for idx, df in enumerate(spiller.iter_partitions()):
+                group_df = group_run_results(df)
+                del df
+                columns = list(group_df.columns)
+                grouped_fpaths.append(path_join(tmpdir, 'grouped-{}.pkl'.format(idx)))
+                with open(grouped_fpaths[-1], 'wb') as fp:
+                    for start in range(0, group_df.shape[0], chunk_size):
+                        pickle.dump(group_df.iloc[start:start+chunk_size], fp)
+
+        # merge the sorted partitions into the output
+        num_rows = 0
+        merged = heapq.merge(*map(iter_spilled_rows, grouped_fpaths), key=lambda row: row[:len(GROUP_COLUMNS)])
+        with stage(profiler, 'merge-write'), DatasetWriter(output) as writer:
+            for rows in iter(lambda: list(islice(merged, chunk_size)), []):
+                writer.write(pd.DataFrame(rows, columns=columns))
+                num_rows += len(rows)
+    return num_rows
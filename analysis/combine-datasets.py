@@ -4,129 +4,97 @@
 
 # std imports
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from glob import glob
 from os.path import join as path_join
 from os import sep as FILE_SEPARATOR
-from csv import QUOTE_NONNUMERIC
 
 # tpl imports
 import pandas as pd
 
+# local imports
+from cache import NormalizedCache
+from normalization import DEFAULT_RULES, load_rules, normalize_columns, normalize_inputs, rules_hash
+from storage import (DATASET_EXTENSIONS, apply_dtypes, compact_dataset, memory_usage_mb, read_dataset,
+    unify_categories, write_dataset)
+
 
 def vprint(verbose, msg, **kwargs):
     if verbose:
         print(msg, **kwargs)
 
-'''
-PAPI_BR_INS,PAPI_LD_INS,PAPI_SR_INS,PAPI_TOT_INS,PAPI_L1_LDM,PAPI_L1_STM,PAPI_L2_LDM,
-PAPI_L2_STM,EPT,FP_ARITH:SCALAR_SINGLE,FP_ARITH:SCALAR_DOUBLE,ARITH,IO Bytes Read,IO Bytes Written,
-PAPI_MEM_WCY,REALTIME (sec)
-'''
-
-'''
-~PAPI_BR_INS ~PAPI_TOT_INS
-amd64_fam17h_zen2::LS_DISPATCH:STORE_DISPATCH amd64_fam17h_zen2::LS_DISPATCH:LD_DISPATCH
-perf::L1-DCACHE-LOAD-MISSES perf::L1-ICACHE-LOAD-MISSES
-perf::STALLED-CYCLES-FRONTEND perf::STALLED-CYCLES-BACKEND 
-IO REALTIME
-gpu=amd
-'''
-
-
-'''
-perf::BRANCH-INSTRUCTIONS power9::PM_LD_CMPL power9::PM_ST_CMPL perf::INSTRUCTIONS
-power9::PM_LD_MISS_L1 power9::PM_ST_MISS_L1 power9::PM_L2_ST_MISS power9::PM_L2_LD_MISS
-PAPI_INT_INS
-PAPI_FP_INS
-perf::STALLED-CYCLES-FRONTEND perf::STALLED-CYCLES-BACKEND
-IO REALTIME
-gpu=nvidia
-'''
-
-def get_unique_col(df, col='machine'):
-    ''' get machine from dataframe '''
-    vals = df[col].unique()
-    assert len(vals) == 1
-    return str(vals[0])
-
-
-def normalize_columns(df):
-    ''' Some of the counter columns are the same thing but have different names
-        on different systems. i.e. clx::ARITH and bdw_ep::ARITH represent the
-        same counter on Ruby and Quartz, respectively. This will adjust the 
-        column names to fix this in `df`. Changes columns in-place.
+
+def find_datasets(datadir):
+    ''' Find the dataset file for each "datadir/<system>/<app>/data.<ext>". If
+        there are several formats for one system and app, then the first of
+        DATASET_EXTENSIONS is used.
     '''
-    CUR_MACHINE = get_unique_col(df, col='machine')
-
-    # remove system specific prefixes
-    SYSTEM_PREFIXES = ['clx::', 'bdw_ep::']
-    for pref in SYSTEM_PREFIXES:
-        df.columns = df.columns.str.replace(pref, '', n=1, regex=False)
-
-    # remove trailing whitespace
-    df.columns = df.columns.str.rstrip()
-
-    if CUR_MACHINE == 'corona':
-        df['PAPI_MEM_WCY'] = df['perf::STALLED-CYCLES-FRONTEND'] + df['perf::STALLED-CYCLES-BACKEND']
-        df['PAPI_L1_LDM'] = df['perf::L1-DCACHE-LOAD-MISSES'] + df['perf::L1-ICACHE-LOAD-MISSES']
-        for col in ['PAPI_L1_STM','PAPI_L2_LDM','PAPI_L2_STM','EPT','FP_ARITH:SCALAR_SINGLE','FP_ARITH:SCALAR_DOUBLE','ARITH']:
-            df[col] = -1
-        df.drop(columns=['perf::STALLED-CYCLES-FRONTEND', 'perf::STALLED-CYCLES-BACKEND', 'perf::L1-DCACHE-LOAD-MISSES', 'perf::L1-ICACHE-LOAD-MISSES'], inplace=True)
-        
-    if CUR_MACHINE == 'lassen':
-        df['PAPI_MEM_WCY'] = df['perf::STALLED-CYCLES-FRONTEND'] + df['perf::STALLED-CYCLES-BACKEND']
-        df['EPT'] = -1
-        df['FP_ARITH:SCALAR_SINGLE'] = -1
-        df.drop(columns=['perf::STALLED-CYCLES-FRONTEND', 'perf::STALLED-CYCLES-BACKEND'], inplace=True)
-
-    column_map = {
-        'amd64_fam17h_zen2::LS_DISPATCH:STORE_DISPATCH': 'PAPI_SR_INS',
-        'amd64_fam17h_zen2::LS_DISPATCH:LD_DISPATCH': 'PAPI_LD_INS',
-        'perf::BRANCH-INSTRUCTIONS': 'PAPI_BR_INS',
-        'power9::PM_LD_CMPL': 'PAPI_LD_INS',
-        'power9::PM_ST_CMPL': 'PAPI_SR_INS',
-        'perf::INSTRUCTIONS': 'PAPI_TOT_INS',
-        'power9::PM_LD_MISS_L1': 'PAPI_L1_LDM',
-        'power9::PM_ST_MISS_L1': 'PAPI_L1_STM', 
-        'power9::PM_L2_ST_MISS': 'PAPI_L2_STM', 
-        'power9::PM_L2_LD_MISS': 'PAPI_L2_LDM',
-        'PAPI_FP_INS': 'FP_ARITH:SCALAR_DOUBLE',
-        'PAPI_INT_INS': 'ARITH',
-        }
-    df.rename(columns=column_map, inplace=True)
-
-
-def normalize_inputs(df):
-    MACHINE = get_unique_col(df, col='machine')
-    APP = get_unique_col(df, col='app')
-    
-    if APP == 'laghos':
-        if MACHINE == 'corona':
-            df['args'] = df['args'].str.replace(r'-d hip', '')
-        elif MACHINE == 'lassen':
-            df['args'] = df['args'].str.replace(r'-d cuda', '')
-        df['args'] = df['args'].str.strip()
-
-
-
-def combine_datasets(datadir, verbose=False):
-    ''' combines data sets in datadir. Assumes datadir is formatted as 
-        "datadir/<system>/<app>/data.csv". Each of these csv's will be concatenated together. 
+    datasets = {}
+    for ext in DATASET_EXTENSIONS:
+        for fpath in glob(path_join(datadir, '**', '**', 'data' + ext)):
+            path_parts = fpath.split(FILE_SEPARATOR)
+            datasets.setdefault((path_parts[-3], path_parts[-2]), fpath)
+    return datasets
+
+
+def load_normalized(fpath, rules=DEFAULT_RULES):
+    ''' Read and normalize one dataset, with every column cast to its dataset dtype.
+    '''
+    df = read_dataset(fpath)
+    normalize_columns(df, rules)
+    normalize_inputs(df, rules)
+    apply_dtypes(df)
+    return df
+
+
+def load_cached(dataset, cache, rules=DEFAULT_RULES):
+    ''' `load_normalized` for the ((system, app), fpath) `dataset` reusing the frame
+        in `cache` if the file and rules have not changed.
+        Returns:
+            (df, key, hit)
     '''
-    search_glob = path_join(datadir, '**', '**', 'data.csv')
+    (system, app), fpath = dataset
+    key = cache.key(fpath, rules_hash(rules))
+    df = cache.get(system, app, key)
+    if df is not None:
+        return df, key, True
+
+    df = load_normalized(fpath, rules)
+    cache.put(system, app, key, df)
+    return df, key, False
 
-    dataframes = []
-    for fpath in glob(search_glob):
-        path_parts = fpath.split(FILE_SEPARATOR)
-        system, app = path_parts[-3], path_parts[-2]
 
-        df = pd.read_csv(fpath)
-        normalize_columns(df)
-        normalize_inputs(df)
-        dataframes.append(df)
+def combine_datasets(datadir, verbose=False, jobs=1, rules=DEFAULT_RULES, cache=None):
+    ''' combines data sets in datadir. Assumes datadir is formatted as 
+        "datadir/<system>/<app>/data.<ext>". Each of these datasets will be concatenated together. 
+        The datasets are loaded and normalized by `jobs` threads. Reading and
+        parsing release the GIL and threads avoid copying each frame between
+        processes. Counters and inputs are normalized following `rules`. If a
+        NormalizedCache `cache` is given, then only datasets whose contents
+        changed are normalized again and stale cache entries are evicted.
+    '''
+    datasets = find_datasets(datadir)
 
-        vprint(verbose, 'Collected dataset for \'{}\' on \'{}\'.'.format(app, system))
-    
+    dataframes = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if cache is None:
+            loaded = ((df, None, False) for df in executor.map(partial(load_normalized, rules=rules), datasets.values()))
+        else:
+            loaded = executor.map(partial(load_cached, cache=cache, rules=rules), datasets.items())
+
+        keys = {}
+        for (system, app), (df, key, hit) in zip(datasets, loaded):
+            dataframes.append(df)
+            keys[(system, app)] = key
+            vprint(verbose, '{} dataset for \'{}\' on \'{}\'.'.format('Reused cached' if hit else 'Collected', app, system))
+
+    if cache is not None:
+        num_evicted = cache.evict(keys)
+        vprint(verbose, 'Reused {} cached datasets and evicted {} stale entries.'.format(cache.hits, num_evicted))
+
+    # every frame has the same dtypes, so concat does not upcast
+    unify_categories(dataframes)
     combined = pd.concat(dataframes, ignore_index=True)
     vprint(verbose, 'Combined datasets.')
     vprint(verbose, 'Final dataset has {} rows and {} columns.'.format(combined.shape[0], combined.shape[1]))
@@ -136,14 +104,27 @@ def combine_datasets(datadir, verbose=False):
 def main():
     parser = ArgumentParser()
     parser.add_argument('-r', '--root', required=True, type=str, help='root of data directories')
-    parser.add_argument('-o', '--output', type=str, help='output csv file')
+    parser.add_argument('-o', '--output', type=str, help='output dataset file (.csv, .parquet or .feather)')
     parser.add_argument('-v', '--verbose', action='store_true', help='turn on verbose')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of threads used to load datasets')
+    parser.add_argument('--rules', type=str, help='json file of normalization rules to use instead of the defaults')
+    parser.add_argument('--cache', type=str, help='directory to cache normalized datasets in. Only datasets ' +
+        'that changed since the last run are normalized again')
+    parser.add_argument('--compact', action='store_true', help='compact the combined dataset in memory and ' +
+        'report its memory use before and after')
     args = parser.parse_args()
 
-    df = combine_datasets(args.root, verbose=args.verbose)
+    rules = load_rules(args.rules) if args.rules else DEFAULT_RULES
+    cache = NormalizedCache(args.cache) if args.cache else None
+    df = combine_datasets(args.root, verbose=args.verbose, jobs=args.jobs, rules=rules, cache=cache)
+
+    if args.compact:
+        before = memory_usage_mb(df)
+        df = compact_dataset(df, fill=rules['fill'])
+        print('Compacted dataset from {:.2f} MB to {:.2f} MB.'.format(before, memory_usage_mb(df)))
 
     if args.output:
-        df.to_csv(args.output, index=False, quoting=QUOTE_NONNUMERIC)
+        write_dataset(df, args.output)
         vprint(args.verbose, 'Wrote combined dataset to \'{}\'.'.format(args.output))
 
 
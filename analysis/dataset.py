@@ -2,9 +2,27 @@
     author: Daniel Nichols
 '''
 
+# std imports
+from inspect import signature
+from os.path import exists
+import json
+
 # tpl imports
+import numpy as np
 import pandas as pd
 
+# local imports
+from cache import file_hash, make_key
+from storage import fill_masked, scan_dataset
+
+
+# bump this whenever get_regression_dataset changes what it builds, so cached
+# datasets are rebuilt
+REGRESSION_DATASET_VERSION = 4
+
+# run meta-data that is not used as features
+META_COLUMNS = ['exec', 'modules', 'spack_env', 'exec_path', 'events', 'path', 'duration']
+
 
 def add_one_hot(df, column, drop=False):
     ''' Add one-hot-encoded columns to df based on column.
@@ -20,8 +38,49 @@ def add_one_hot(df, column, drop=False):
     return df
 
 
+def get_run_sizes(ranks):
+    ''' 'core' for single rank runs and 'node' for the rest. '''
+    return np.where(np.asarray(ranks) == 1, 'core', 'node')
+
+
+def get_relative_times(df, relative_to='min'):
+    ''' Relative time of each run in `df` on every machine. `df` is indexed by
+        app, args, ranks and machine. Runs with the same app, args and number of
+        ranks are compared across machines. The runtimes are scattered into a
+        (run group, machine) matrix in one pass instead of pivoting and merging
+        the result back.
+        Returns:
+            A frame with the index of `df` and a '<machine> Relative Time'
+            column for each machine, sorted by name.
+    '''
+    index = df.index
+    groups, _ = index.droplevel('machine').factorize()
+    machine_codes, machines = pd.factorize(index.get_level_values('machine').astype(str), sort=True)
+    num_groups, num_machines = groups.max() + 1, len(machines)
+
+    cells = groups * num_machines + machine_codes
+    if np.bincount(cells, minlength=num_groups * num_machines).max() > 1:
+        raise ValueError('Each app, args and ranks can only have one run per machine.')
+
+    times = np.full((num_groups, num_machines), np.nan)
+    times[groups, machine_codes] = df['REALTIME (sec)'].to_numpy(dtype='float64')
+
+    # calculate performance relative to min/max across systems or to one system
+    if relative_to == 'min':
+        rel = np.nanmin(times, axis=1)
+    elif relative_to == 'max':
+        rel = np.nanmax(times, axis=1)
+    elif relative_to is None:
+        rel = np.ones(num_groups)
+    else:
+        rel = times[:, machines.get_loc(relative_to)]
+
+    columns = [machine + ' Relative Time' for machine in machines]
+    return pd.DataFrame((times / rel[:, np.newaxis])[groups], index=index, columns=columns)
+
+
 def get_regression_dataset(df, relative_to='min', include_app=False, run_size='all', round_targets=False,
-    include_runtime=None):
+    include_runtime=None, apps=('laghos',)):
     ''' Build a dataset for regression. Regressor target is n-vector of relative
         performance across available systems.
         Args:
@@ -37,55 +96,43 @@ def get_regression_dataset(df, relative_to='min', include_app=False, run_size='a
             round_targets: If true, then round regressor targets to nearest
                 integer.
             include_runtime: One of 'overhead', 'absolute', 'both', or None.
+            apps: Applications to include or None for all of them.
+        `df` may be a compact dataset. The features keep its compact dtypes and
+        missing counters are given their fill value again.
     '''
     assert run_size in ['core', 'node', 'all']
     assert include_runtime in ['overhead', 'absolute', 'both', None]
 
     # create copy of data
-    df = df.copy(deep=True)
+    df = fill_masked(df).copy(deep=True)
 
-    # filter ranks
-    if run_size == 'core':
-        df = df[df['ranks'] == 1]
-    elif run_size == 'node':
-        raise NotImplementedError('node run_size filter not yet implemented.')
-    else:
-        pass
+    # filter apps and ranks
+    if apps is not None:
+        df = df[df['app'].isin(apps)]
+    if run_size != 'all':
+        df = df[get_run_sizes(df['ranks']) == run_size]
+
+    # only one-hot-encode the machines and apps that are left
+    for col in ['app', 'machine']:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
 
     # calculate overhead column if needed; do this before 'duration' is dropped
     if include_runtime in ['overhead', 'both']:
-        df['Overhead'] = (df['duration']*60.0) - df['REALTIME (sec)']
+        # in float64, as compact datasets may hold these as float32
+        df['Overhead'] = (df['duration'].astype('float64')*60.0) - df['REALTIME (sec)'].astype('float64')
 
     # remove meta-data columns and set index
-    df = df[df['app'] == 'laghos']
-    df.drop(['exec', 'modules', 'spack_env', 'exec_path', 'events', 'path', 'duration'], axis=1, inplace=True)
+    df = df.drop(META_COLUMNS, axis=1, errors='ignore')
     df.set_index(['app', 'args', 'ranks', 'machine'], inplace=True)
-
-    # show columns with na
-    #print(df.columns[df.isna().any()].tolist())
     df.dropna(axis=1, inplace=True)
 
-    # calculate performance relative to minimum across systems
-    if relative_to in ['min', 'max']:
-        rel = df['REALTIME (sec)'].groupby(['app', 'args', 'ranks']).agg(relative_to)
-        df['Relative Time'] = df['REALTIME (sec)'] / rel
-    else:
-        rel = df.loc[:,:,:,relative_to]['REALTIME (sec)']
-        df['Relative Time'] = df['REALTIME (sec)'] / rel
-        #print(df['Relative Time'].values)
-
-    #df[['REALTIME (sec)', 'Relative Time']].to_csv('times.csv')
-    #exit(0)
-
-    # expand relative times from each machine to columns; and add those columns to df
-    pivot_df = pd.pivot(df.reset_index(), index=['app', 'args', 'ranks'], columns='machine', values='Relative Time')
-    pivot_df.columns = pivot_df.columns + ' Relative Time'
-    merged_df = df.merge(pivot_df, left_index=True, right_index=True, validate='1:1')
+    # add relative times from each machine as columns
+    df = pd.concat([df, get_relative_times(df, relative_to=relative_to)], axis=1)
 
     # one-hot-encode machine column
-    merged_df.reset_index(inplace=True)
-    df = add_one_hot(merged_df, 'machine')
-    df.drop('Relative Time', axis=1, inplace=True)
+    df.reset_index(inplace=True)
+    df = add_one_hot(df, 'machine')
     df.set_index(['app', 'args', 'ranks', 'machine'], inplace=True)
 
     # remove absolute runtime column if requested
@@ -103,4 +150,152 @@ def get_regression_dataset(df, relative_to='min', include_app=False, run_size='a
         target_cols = df.columns[df.columns.str.endswith('Relative Time')]
         df[target_cols] = df[target_cols].round(2).astype('float64')
 
-    return df
\ No newline at end of file
+    return df
+
+
+def regression_query(fpath, apps=('laghos',), run_size='all', include_runtime=None):
+    ''' LazyDataset over `fpath` that only reads the rows and columns
+        get_regression_dataset uses with these arguments.
+    '''
+    query = scan_dataset(fpath)
+    if apps is not None:
+        query = query.filter(app=list(apps))
+    if run_size == 'core':
+        query = query.filter(ranks=1)
+
+    unused = [col for col in META_COLUMNS if col != 'duration' or include_runtime not in ['overhead', 'both']]
+    return query.select([col for col in query.schema_columns() if col not in unused])
+
+
+def _regression_arguments(kwargs):
+    ''' Every argument of get_regression_dataset but `df`, with defaults filled in. '''
+    bound = signature(get_regression_dataset).bind(None, **kwargs)
+    bound.apply_defaults()
+    return {name: val for name, val in bound.arguments.items() if name != 'df'}
+
+
+def _transform_name(transform):
+    ''' Qualified name of a `transform` function, which the cache keys include. '''
+    return None if transform is None else '{}.{}'.format(transform.__module__, transform.__qualname__)
+
+
+def load_regression_dataset(fpath, cache=None, transform=None, **kwargs):
+    ''' `get_regression_dataset(df, **kwargs)` for the dataset at `fpath`, reading
+        only what `regression_query` selects. `transform` is applied to the
+        frame that is read before the dataset is built. The result is memoized
+        in the FeatureCache `cache`, keyed on the contents of `fpath`, every
+        argument of get_regression_dataset and the name of `transform`, so the
+        dataset is only read and built again when any of them changes.
+    '''
+    arguments = _regression_arguments(kwargs)
+
+    def build():
+        df = regression_query(fpath, apps=arguments['apps'], run_size=arguments['run_size'],
+            include_runtime=arguments['include_runtime']).collect()
+        if transform is not None:
+            df = transform(df)
+        return get_regression_dataset(df, **kwargs)
+
+    if cache is None:
+        return build()
+
+    key = cache.key(fpath, REGRESSION_DATASET_VERSION, sorted(arguments.items()), _transform_name(transform))
+    df = cache.get(key)
+    if df is None:
+        df = build()
+        cache.put(key, df)
+    return df
+
+
+def get_target_columns(df):
+    ''' The '<machine> Relative Time' targets of a regression dataset, in order of
+        machine name.
+    '''
+    return [col for col in df.columns if col.endswith(' Relative Time')]
+
+
+def get_feature_columns(df, targets=None):
+    ''' Every column of a regression dataset that is not in `targets` (all
+        targets by default), in the order of `df`: counters, runtime columns,
+        then the one-hot machine and app columns.
+    '''
+    targets = get_target_columns(df) if targets is None else targets
+    return [col for col in df.columns if col not in targets]
+
+
+def export_arrays(df, targets=None, features=None, prefix=None, key=None):
+    ''' Export a regression dataset as C-contiguous float32 feature and target
+        matrices, ready for `torch.from_numpy`, sklearn and XGBoost without any
+        further copies. Rows with missing values are dropped. Each column is
+        written straight into the output, so no float64 copy of the frame is
+        made. `index` is the (app, args, ranks, machine) index of the rows that
+        are kept, for grouping them into folds. If `prefix` is given, then the
+        matrices are written to '<prefix>.X.npy' and '<prefix>.y.npy' and
+        returned memory-mapped, with the index in '<prefix>.index.pkl' and the
+        column orders and `key` in '<prefix>.json'; see `load_arrays`.
+        Returns:
+            (X, y, features, targets, index)
+    '''
+    targets = get_target_columns(df) if targets is None else list(targets)
+    features = get_feature_columns(df, targets) if features is None else list(features)
+    rows = df[features + targets].notna().all(axis=1).to_numpy()
+    num_rows = int(rows.sum())
+
+    arrays = []
+    for name, columns in [('X', features), ('y', targets)]:
+        if prefix is None:
+            out = np.empty((num_rows, len(columns)), dtype=np.float32)
+        else:
+            out = np.lib.format.open_memmap('{}.{}.npy'.format(prefix, name), mode='w+', dtype=np.float32,
+                shape=(num_rows, len(columns)))
+        for idx, col in enumerate(columns):
+            out[:, idx] = df[col].to_numpy()[rows]
+        arrays.append(out)
+    index = df.index[rows]
+
+    if prefix is not None:
+        for out in arrays:
+            out.flush()
+        index.to_frame(index=False).to_pickle(prefix + '.index.pkl')
+        with open(prefix + '.json', 'w') as fp:
+            json.dump({'key': key, 'features': features, 'targets': targets}, fp)
+    return arrays[0], arrays[1], features, targets, index
+
+
+def load_arrays(prefix, key=None):
+    ''' Matrices written by `export_arrays` with `prefix`, or None if there are none
+        for `key`. They are memory-mapped copy-on-write, so processes training on
+        the same files share their pages and in-place changes such as scaling
+        never reach the files.
+        Returns:
+            (X, y, features, targets, index) or None
+    '''
+    if not all(exists(prefix + ext) for ext in ['.json', '.X.npy', '.y.npy', '.index.pkl']):
+        return None
+    with open(prefix + '.json', 'r') as fp:
+        info = json.load(fp)
+    if info['key'] != key:
+        return None
+
+    X = np.load(prefix + '.X.npy', mmap_mode='c')
+    y = np.load(prefix + '.y.npy', mmap_mode='c')
+    index = pd.MultiIndex.from_frame(pd.read_pickle(prefix + '.index.pkl'))
+    return X, y, info['features'], info['targets'], index
+
+
+def load_regression_arrays(fpath, targets=None, features=None, prefix=None, cache=None, transform=None, **kwargs):
+    ''' `export_arrays` for `load_regression_dataset(fpath, ...)`. With a `prefix`,
+        the memory-mapped matrices are reused as long as the contents of `fpath`,
+        the dataset arguments, `transform` and the columns are the same.
+    '''
+    key = None
+    if prefix is not None:
+        arguments = _regression_arguments(kwargs)
+        key = make_key(file_hash(fpath), REGRESSION_DATASET_VERSION, sorted(arguments.items()),
+            _transform_name(transform), targets, features)
+        arrays = load_arrays(prefix, key)
+        if arrays is not None:
+            return arrays
+
+    df = load_regression_dataset(fpath, cache=cache, transform=transform, **kwargs)
+    return export_arrays(df, targets=targets, features=features, prefix=prefix, key=key)
@@ -4,144 +4,253 @@
 '''
 # std imports
 from argparse import ArgumentParser
+from os import cpu_count, environ
+from os.path import exists
+from time import perf_counter
+import pickle
 
 # tpl imports
-from alive_progress import alive_it
 import numpy as np
 import pandas as pd
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-import torch.utils.data as data_utils
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.optim as optim
-import torchvision
-import torchvision.transforms as transforms
+from torch.nn.parallel import DistributedDataParallel
 
 # local imports
-from dataset import get_regression_dataset
+from cache import DEFAULT_FEATURE_CACHE_MB, FeatureCache, file_hash
+from dataset import load_regression_arrays
+from network import TARGETS, THROUGHPUT_BATCH_SIZE, EarlyStopping, Net, NetPredictor, fit_normalizer, \
+    load_checkpoint, normalized_rows, predict, regression_metrics, save_checkpoint, split_indices, train_regression
+from storage import compact_frame
+
+
+DEFAULT_MASTER_PORT = 29500
 
 
 def get_args():
     parser = ArgumentParser()
-    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset')
+    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset (.csv, .parquet or .feather)')
     parser.add_argument('-t', '--task', type=str, choices=['regression', 'classification'], default='regression',
         help='What training problem to run.')
-    parser.add_argument('--hidden-sizes', type=int, nargs='+', default=[128], help='size of hidden layers')
-    parser.add_argument('--batch-size', type=int, default=4, help='training batch size')
+    parser.add_argument('--hidden-sizes', type=int, nargs='+', default=[128], help='size of hidden layers. An ' +
+        'output layer with a unit per target follows them')
+    parser.add_argument('--batch-size', type=int, help='training batch size (default: 4, or ' +
+        '{} with --throughput)'.format(THROUGHPUT_BATCH_SIZE))
+    parser.add_argument('--throughput', action='store_true', help='train on large batches sliced from in-memory ' +
+        'tensors instead of a DataLoader, without per-step progress updates')
+    parser.add_argument('--threads', type=int, help='intra-op threads used by torch in each process (default: ' +
+        'the cores divided among the processes on a node)')
+    parser.add_argument('--nprocs', type=int, default=1, help='data-parallel training processes to start on this ' +
+        'machine. Use torchrun instead to train across nodes')
+    parser.add_argument('--test-size', type=float, default=0.1, help='fraction of samples held out for evaluation')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the split, initial weights, ' +
+        'shuffling and batching')
+    parser.add_argument('--learning-rate', type=float, default=0.001, help='learning rate of the Adam optimizer')
+    parser.add_argument('--val-size', type=float, default=0.1, help='fraction of the training samples used to ' +
+        'validate every epoch. The weights of the epoch with the lowest validation loss are kept')
+    parser.add_argument('--patience', type=int, help='stop after this many epochs without a better validation loss')
+    parser.add_argument('--checkpoint', type=str, help='file to save the model and optimizer state to')
+    parser.add_argument('--checkpoint-every', type=int, default=1, help='epochs between checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from --checkpoint if it exists')
     parser.add_argument('--epochs', type=int, default=5, help='# of training epochs')
-    return parser.parse_args()
-
-
-def normalize(X):
-    ''' normalize data set.
-    '''
-    from sklearn.preprocessing import StandardScaler
-    return StandardScaler().fit_transform(X)
-
-
-def same_order_score(y_true, y_pred):
-    ''' Check how many elements share same ordering.
-    '''
-    from scipy.stats import rankdata
-    same_order = lambda x: np.array_equal(rankdata(x[0]), rankdata(x[1]))
-    total_same = sum(map(same_order, zip(y_true, y_pred)))
-    return float(total_same) / y_pred.shape[0]
-
-
-def regression_metrics(y_true, y_pred):
-    ''' Return a dict of metrics based on y_true and y_pred results.
+    parser.add_argument('--save-model', type=str, help='pickle the trained network and its fitted preprocessing here')
+    parser.add_argument('--compact', action='store_true', help='keep the dataset in memory with compact dtypes')
+    parser.add_argument('--cache', type=str, help='directory to cache built training datasets in')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_FEATURE_CACHE_MB, help='max size of the ' +
+        'cache in MB. Least recently used datasets are evicted')
+    parser.add_argument('--arrays', type=str, help='path prefix of memory-mapped float32 feature and target ' +
+        'files. They are reused while the dataset is unchanged and can be shared by several runs')
+    args = parser.parse_args()
+
+    if args.patience is not None and args.val_size <= 0:
+        parser.error('--patience needs a validation set to stop on; use a --val-size above 0')
+    return args
+
+
+def evaluate_regression(model, X, y, batch_size=4096):
+    ''' Print example predictions and the metrics of `model` on all of `X` and `y`.
     '''
-    from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, explained_variance_score
-    return {
-        'r2': r2_score(y_true, y_pred),
-        'mse': mean_squared_error(y_true, y_pred),
-        'mae': mean_absolute_error(y_true, y_pred),
-        'evs': explained_variance_score(y_true, y_pred),
-        'sos': same_order_score(y_true, y_pred)
-    }
-
-
-class Net(nn.Module):
-    def __init__(self, hidden_sizes=(128, 64)):
-        super(Net, self).__init__()
-
-        self.fc_layers_ = nn.Sequential(*[nn.LazyLinear(hs) for hs in hidden_sizes])
-
-    def forward(self, x):
-        for layer in self.fc_layers_[:-1]:
-            x = F.relu( layer(x) )
-        
-        x = self.fc_layers_[-1](x)
-        return x
-
-
-def train_regression(ds, model, learning_rate=0.001, epochs=5):
-    criterion = nn.L1Loss()
-    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
-
-    for epoch in range(epochs):
-
-        running_loss, total_loss = 0.0, 0.0
-        bar = alive_it(ds, title='Epoch {}'.format(epoch), force_tty=True, theme='smooth', receipt=True, receipt_text=True)
-        for idx, (inputs, targets) in enumerate(bar, 0):
-
-            optimizer.zero_grad()
-
-            outputs = model(inputs)
-            loss = criterion(outputs, targets)
-            loss.backward()
-            optimizer.step()
-
-            running_loss += loss.item()
-
-            total_loss = running_loss / (idx + 1)
-            bar.text = 'Loss: {:.3f}'.format(total_loss)
-
+    start = perf_counter()
+    y_pred = predict(model, X, batch_size=batch_size).numpy()
+    seconds = perf_counter() - start
+    y_true = y.numpy()
 
     print('\nExample Outputs:')
     print('Actual\t\t\tPredicted')
     print('------\t\t\t--------')
-    LIM = 50
-    y_true, y_pred = [], []
-    for _ in range(LIM // ds.batch_size):
-        batch, actual = iter(ds).next()
-        predicted = model(batch).detach()
-        batch, predicted = batch.numpy(), predicted.numpy()
-        y_true.append(actual)
-        y_pred.append(predicted)
-
-        for tr, pr in zip(actual, predicted):
-            tr_list, pr_list = ['{:0.4f}'.format(x) for x in tr], ['{:0.4f}'.format(x) for x in pr]
-            print('{} -> {}'.format(str(tr_list), str(pr_list)))
-    
-    y_true = np.concatenate(y_true)
-    y_pred = np.concatenate(y_pred)
+    LIM = 10
+    for tr, pr in zip(y_true[:LIM], y_pred[:LIM]):
+        tr_list, pr_list = ['{:0.4f}'.format(x) for x in tr], ['{:0.4f}'.format(x) for x in pr]
+        print('{} -> {}'.format(str(tr_list), str(pr_list)))
+
     scores = regression_metrics(y_true, y_pred)
     print()
+    print('Evaluated {:,} held out samples in {:.3f}s ({:,.0f} samples/sec).'.format(len(X), seconds,
+        len(X) / max(seconds, 1e-9)))
     for metric, score in scores.items():
-        print('{:3}: {:.3f}'.format(metric, score))
+        print('{:5}: {:.3f}'.format(metric, score))
 
 
-def main():
-    args = get_args()
+def init_distributed(rank, world_size):
+    ''' Join the gloo process group of `world_size` processes as `rank`. The
+        address of rank 0 is read from MASTER_ADDR and MASTER_PORT, which default
+        to a port on this machine for processes started by `--nprocs`.
+    '''
+    environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    environ.setdefault('MASTER_PORT', str(DEFAULT_MASTER_PORT))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
 
-    df = pd.read_csv(args.dataset)
-    df = get_regression_dataset(df, relative_to='min', include_app=False, run_size='core',
-        round_targets=False, include_runtime='both')
-    df.dropna(inplace=True)
 
-    TARGETS = ['quartz Relative Time', 'ruby Relative Time']
-    FEATURES = list(set(df.columns) - set(TARGETS))
-    ds = data_utils.TensorDataset(
-        torch.tensor(normalize(df[FEATURES].values)).float(), 
-        torch.tensor(df[TARGETS].values).float())
-    dl = data_utils.DataLoader(ds, batch_size=args.batch_size, shuffle=True)
+def run_settings(args, world_size):
+    ''' The settings a checkpoint can only be resumed with. Any other dataset,
+        split, seed or number of processes would put different rows in the
+        training, validation and test sets.
+    '''
+    return {'dataset': file_hash(args.dataset), 'hidden_sizes': list(args.hidden_sizes), 'seed': args.seed,
+        'test_size': args.test_size, 'val_size': args.val_size, 'learning_rate': args.learning_rate,
+        'world_size': world_size}
 
-    model = Net(args.hidden_sizes)
 
-    train_regression(dl, model, epochs=args.epochs)
+def resume(checkpoint, settings, net, optimizer, stopper, generator):
+    ''' Restore the training state saved in `checkpoint` after checking that it
+        was saved with the same `run_settings`. Returns the epoch to continue
+        from.
+    '''
+    saved = checkpoint.get('settings', {})
+    changed = [name for name in settings if saved.get(name) != settings[name]]
+    if changed:
+        raise ValueError('Cannot resume a checkpoint with different {}: saved {}, not {}.'.format(', '.join(changed),
+            [saved.get(name) for name in changed], [settings[name] for name in changed]))
+    net.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    stopper.load_state_dict(checkpoint['stopper'])
+    generator.set_state(checkpoint['generator'])
+    return checkpoint['epoch'] + 1
+
+
+def load_shards(args, rank, world_size, local_rank, generator):
+    ''' Split the dataset into training, validation and test rows and normalize
+        the rows this process needs: its `rank`'s shard of the training rows,
+        the validation rows and, for rank 0, the test rows. The local rank 0 of
+        every node builds any cached dataset or `--arrays` files first and the
+        other processes on the node then read them. With `--arrays`, the matrices
+        are memory-mapped, so a process only reads the rows it uses. The
+        normalizer is fit by rank 0 and sent to the others.
+        Returns:
+            (X_train, y_train, X_val, y_val, X_test, y_test, normalizer, features)
+            where the validation and test tensors may be None
+    '''
+    if local_rank != 0:
+        dist.barrier()
+    cache = FeatureCache(args.cache, max_mb=args.cache_size) if args.cache else None
+    X, y, features, _, _ = load_regression_arrays(args.dataset, targets=TARGETS, prefix=args.arrays, cache=cache,
+        transform=compact_frame if args.compact else None, relative_to='min', include_app=False, run_size='core',
+        round_targets=False, include_runtime='both')
+    if local_rank == 0 and world_size > 1:
+        dist.barrier()
+
+    train_idx, test_idx = split_indices(len(X), args.test_size, generator)
+    val_idx = None
+    if args.val_size > 0:
+        train_pos, val_pos = split_indices(len(train_idx), args.val_size, generator)
+        train_idx, val_idx = train_idx[train_pos], train_idx[val_pos]
+
+    normalizer = [fit_normalizer(X, features, train_idx) if rank == 0 else None]
+    if world_size > 1:
+        dist.broadcast_object_list(normalizer, src=0)
+    normalizer = normalizer[0]
+
+    # equal shards, so every process takes the same number of steps
+    shard = train_idx[rank::world_size][:len(train_idx) // world_size]
+    X_train, y_train = normalized_rows(X, y, shard, normalizer)
+    X_val, y_val = normalized_rows(X, y, val_idx, normalizer) if val_idx is not None else (None, None)
+    X_test, y_test = normalized_rows(X, y, test_idx, normalizer) if rank == 0 else (None, None)
+    return X_train, y_train, X_val, y_val, X_test, y_test, normalizer, features
+
+
+def train(rank, args, world_size=1, local_world_size=1, local_rank=None):
+    ''' Load this process's shard of the dataset, train on it as process `rank`
+        of `world_size` and, as rank 0, evaluate the model on the held out
+        samples. `local_rank` is the rank on this node and defaults to `rank`.
+    '''
+    if world_size > 1:
+        init_distributed(rank, world_size)
+    torch.set_num_threads(args.threads or max(1, cpu_count() // local_world_size))
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+
+    X_train, y_train, X_val, y_val, X_test, y_test, normalizer, features = load_shards(args, rank, world_size,
+        rank if local_rank is None else local_rank, generator)
+
+    batch_size = args.batch_size or (THROUGHPUT_BATCH_SIZE if args.throughput else 4)
+    if rank == 0:
+        print('Training on {:,} samples with batches of {} in {} processes of {} threads.'.format(
+            len(X_train) * world_size, batch_size, world_size, torch.get_num_threads()))
+    net = Net(args.hidden_sizes, num_outputs=len(TARGETS))
+    # lazy layers get their shapes before a checkpoint is loaded into them or DDP
+    # copies rank 0's parameters to every process
+    with torch.no_grad():
+        net(X_train[:1])
+    optimizer = optim.Adam(net.parameters(), lr=args.learning_rate)
+    stopper = EarlyStopping(args.patience)
+
+    start_epoch, settings = 0, run_settings(args, world_size) if args.checkpoint else None
+    if args.checkpoint and args.resume and exists(args.checkpoint):
+        start_epoch = resume(load_checkpoint(args.checkpoint), settings, net, optimizer, stopper, generator)
+        if rank == 0:
+            print('Resumed from \'{}\' at epoch {}.'.format(args.checkpoint, start_epoch))
+    model = DistributedDataParallel(net) if world_size > 1 else net
+
+    def on_epoch(epoch, loss):
+        if X_val is not None:
+            # every rank has the same weights and validation rows, so they all stop together
+            val_loss = (predict(net, X_val) - y_val).abs().mean().item()
+            stopper.step(epoch, val_loss, net)
+            if rank == 0:
+                print('Epoch {}: validation loss {:.3f} (best {:.3f} at epoch {})'.format(epoch, val_loss,
+                    stopper.best_loss, stopper.best_epoch))
+        last = stopper.stopped or epoch + 1 == args.epochs
+        if rank == 0 and args.checkpoint and ((epoch + 1) % args.checkpoint_every == 0 or last):
+            save_checkpoint(args.checkpoint, epoch=epoch, model=net.state_dict(), optimizer=optimizer.state_dict(),
+                stopper=stopper.state_dict(), generator=generator.get_state(), settings=settings)
+        return stopper.stopped
+
+    if stopper.stopped:
+        if rank == 0:
+            print('Training already stopped early at epoch {}.'.format(start_epoch - 1))
+    else:
+        train_regression(X_train, y_train, model, epochs=args.epochs, batch_size=batch_size,
+            in_memory=args.throughput, generator=generator, rank=rank, world_size=world_size, on_epoch=on_epoch,
+            optimizer=optimizer, start_epoch=start_epoch)
+    if stopper.best_weights is not None:
+        net.load_state_dict(stopper.best_weights)
+        if rank == 0:
+            print('Using the weights of epoch {} with validation loss {:.3f}.'.format(stopper.best_epoch,
+                stopper.best_loss))
+    if rank == 0:
+        evaluate_regression(net, X_test, y_test)
+        if args.save_model:
+            with open(args.save_model, 'wb') as fp:
+                pickle.dump(NetPredictor(net, normalizer, features, TARGETS), fp, protocol=pickle.HIGHEST_PROTOCOL)
+            print('Wrote the network with its fitted preprocessing to \'{}\'.'.format(args.save_model))
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def main():
+    args = get_args()
 
+    if args.nprocs > 1:
+        mp.spawn(train, args=(args, args.nprocs, args.nprocs), nprocs=args.nprocs)
+    elif int(environ.get('WORLD_SIZE', 1)) > 1:
+        # started by torchrun, possibly on several nodes
+        train(int(environ['RANK']), args, int(environ['WORLD_SIZE']), int(environ.get('LOCAL_WORLD_SIZE', 1)),
+            int(environ.get('LOCAL_RANK', 0)))
+    else:
+        train(0, args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,230 @@
+''' Detect failed profiling runs from the contents of their run directories.
+'''
+# std imports
+from collections import namedtuple
+from mmap import mmap, ACCESS_READ
+from os import listdir
+from os.path import basename, getsize, isdir, join as path_join
+from time import time
+import json
+import re
+import sqlite3
+
+# local imports
+from profiling import timed
+
+
+EXPECTED_FILES = ['std.out', 'std.err', 'results.json']
+UNEXPECTED_FILES = ['hpctoolkit-database', 'hpctoolkit-measurements']
+
+# bytes at the end of a log that are scanned before the rest of the file. Slurm
+# writes its time limit message as the very last line of std.err.
+TAIL_BYTES = 64 * 1024
+
+# failure signatures for each log file, in order of precedence. All of the
+# signatures for one file are compiled into a single matcher.
+LOG_SIGNATURES = {
+    'std.err': [
+        ('segfault', rb'Segmentation fault \(signal 11\)'),
+        ('time-limit', rb'DUE TO TIME LIMIT \*\*\*[ \t\r\f\v]*$'),
+        ('errored', rb'^[ \t\r\f\v]*FileNotFoundError: \[Errno 2\] No such file or directory: '
+            rb'\'hpctoolkit-database/experiment\.xml\'[ \t\r\f\v]*$'),
+    ],
+    'std.out': [
+        # hpctoolkit build-db error
+        ('errored', rb'^[ \t\r\f\v]*ERROR: \[Diagnostics::FatalException\] Error:'),
+    ],
+}
+
+# what each kind of failure is reported as. Kinds without a message fail silently.
+FAILURE_MESSAGES = {
+    'leftover-measurements': 'ran out of time',
+    'segfault': 'segfaulted',
+    'time-limit': 'ran out of time',
+    'errored': 'errored during run',
+}
+
+
+# failures that are final. Other kinds, such as missing files, may be runs that
+# have not finished yet.
+CATALOGED_KINDS = list(FAILURE_MESSAGES)
+
+
+RunFailure = namedtuple('RunFailure', ['kind', 'input_args'])
+RunFailure.__doc__ = ''' Why a run directory is invalid. `kind` is one of 'not-a-directory', 'missing-files',
+    'leftover-measurements', 'bad-results-json' or a key of a LOG_SIGNATURES entry.
+'''
+
+
+def _compile_signatures(signatures):
+    pattern = b'|'.join(b'(?P<g%d>%s)' % (idx, regex) for idx, (_, regex) in enumerate(signatures))
+    return re.compile(pattern, re.MULTILINE), [kind for kind, _ in signatures]
+
+
+LOG_MATCHERS = {fname: _compile_signatures(sigs) for fname, sigs in LOG_SIGNATURES.items()}
+
+
+def scan_log(fpath):
+    ''' Scan the log file at `fpath` for its failure signatures. The last
+        TAIL_BYTES of the file are searched first, and if they hold any signature
+        the highest precedence kind among them is the verdict, so the rest of a
+        huge log is never read. Only a tail without any signature falls back to
+        scanning the rest of the file. The file is memory mapped, so the search
+        runs over the raw bytes rather than over Python-level lines. Returns the
+        failure kind found or None.
+    '''
+    matcher, kinds = LOG_MATCHERS[basename(fpath)]
+    size = getsize(fpath)
+    if size == 0:
+        return None
+
+    with timed('scan-' + basename(fpath)) as info, open(fpath, 'rb') as fp, \
+        mmap(fp.fileno(), 0, access=ACCESS_READ) as buf:
+        # the tail begins on a line boundary so that no line is split between regions
+        tail_start = buf.rfind(b'\n', 0, max(0, size - TAIL_BYTES)) + 1
+        for start, end in [(tail_start, size), (0, tail_start)]:
+            info['bytes'] += end - start
+            found = set()
+            for match in matcher.finditer(buf, start, end):
+                kind = kinds[int(match.lastgroup[1:])]
+                if kind == kinds[0]:
+                    return kind
+                found.add(kind)
+            if found:
+                return next(kind for kind in kinds if kind in found)
+    return None
+
+
+def get_input_to_failed_job(dirpath, contents=None):
+    ''' Recover the input arguments to a failed run. The 'results.json' file may
+        be ill-formatted. `contents` can be passed if the file has already been read.
+    '''
+    if contents is None:
+        with open(path_join(dirpath, 'results.json'), 'r') as fp:
+            contents = fp.read()
+
+    try:
+        return json.loads(contents)['args']
+    except json.JSONDecodeError:
+        start_str = '\t"args": "'
+        for line in contents.splitlines():
+            if line.startswith(start_str):
+                return line[len(start_str):-2]
+    return ''
+
+
+def check_results_dir(dirpath, files=None):
+    ''' Checks if `dirpath` points to a valid results directory. i.e. does it
+        exist, is the data in the correct format and did the run finish cleanly.
+        Each file in the directory is read at most once. `files` can be passed if
+        the directory has already been listed.
+        Returns:
+            (results, failure) where results is the parsed results.json for valid
+            directories and failure is a RunFailure for invalid ones.
+    '''
+    if files is None:
+        if not isdir(dirpath):
+            return None, RunFailure('not-a-directory', '')
+        with timed('list'):
+            files = listdir(dirpath)
+
+    if not all(fname in files for fname in EXPECTED_FILES):
+        return None, RunFailure('missing-files', '')
+
+    with timed('read-results') as info, open(path_join(dirpath, 'results.json'), 'r') as fp:
+        contents = fp.read()
+        info['bytes'] = len(contents)
+
+    if any(fname in files for fname in UNEXPECTED_FILES):
+        return None, RunFailure('leftover-measurements', get_input_to_failed_job(dirpath, contents))
+
+    try:
+        with timed('parse-results'):
+            results = json.loads(contents)
+    except ValueError:
+        return None, RunFailure('bad-results-json', get_input_to_failed_job(dirpath, contents))
+
+    for fname in LOG_SIGNATURES:
+        kind = scan_log(path_join(dirpath, fname))
+        if kind is not None:
+            return None, RunFailure(kind, results['args'])
+
+    return results, None
+
+
+def describe_failure(dirpath, failure):
+    ''' Human readable message for `failure` or None if it is not reported.
+    '''
+    if failure.kind not in FAILURE_MESSAGES:
+        return None
+    return 'Profile at \'{}\' {} on input \'{}\'.'.format(basename(dirpath.rstrip('/')),
+        FAILURE_MESSAGES[failure.kind], failure.input_args)
+
+
+class FailureCatalog:
+    ''' Persistent sqlite catalog of failed runs. Each run is keyed by its tree
+        root and run directory name and stores the machine, app, input args and
+        failure kind, with the fingerprint of the directory when it was examined.
+        Known failures can then be skipped by later collections and queried
+        without touching the run directories.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS failures (
+            root TEXT NOT NULL,
+            name TEXT NOT NULL,
+            machine TEXT NOT NULL,
+            app TEXT NOT NULL,
+            input_args TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            recorded REAL NOT NULL,
+            PRIMARY KEY (root, name)
+        );
+        CREATE INDEX IF NOT EXISTS failures_by_machine_app ON failures (machine, app, kind);
+        CREATE INDEX IF NOT EXISTS failures_by_kind ON failures (kind);
+    '''
+
+    def __init__(self, fpath):
+        self.conn = sqlite3.connect(fpath)
+        self.conn.executescript(self.SCHEMA)
+
+    def entries(self, root):
+        ''' Known failures under `root` as {name: (fingerprint, RunFailure)}.
+        '''
+        rows = self.conn.execute('SELECT name, fingerprint, kind, input_args FROM failures WHERE root = ?', (root,))
+        return {name: (json.loads(fingerprint), RunFailure(kind, input_args))
+            for name, fingerprint, kind, input_args in rows}
+
+    def record(self, root, machine, app, failures):
+        ''' Add or replace failures under `root` given as (name, fingerprint, RunFailure).
+        '''
+        now = time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(root, name, machine, app, failure.input_args, failure.kind, json.dumps(fingerprint), now)
+                    for name, fingerprint, failure in failures])
+
+    def forget(self, root, names):
+        ''' Remove runs under `root` that no longer fail.
+        '''
+        with self.conn:
+            self.conn.executemany('DELETE FROM failures WHERE root = ? AND name = ?', [(root, name) for name in names])
+
+    def query(self, machine=None, app=None, kind=None, input_args=None):
+        ''' Failures matching every given filter. `input_args` is an sqlite LIKE
+            pattern. Returns a list of dicts ordered by machine, app and args.
+        '''
+        filters = [('machine = ?', machine), ('app = ?', app), ('kind = ?', kind), ('input_args LIKE ?', input_args)]
+        filters = [(clause, val) for clause, val in filters if val is not None]
+        sql = 'SELECT root, name, machine, app, input_args, kind, recorded FROM failures'
+        if filters:
+            sql += ' WHERE ' + ' AND '.join(clause for clause, _ in filters)
+        sql += ' ORDER BY machine, app, input_args, name'
+
+        cursor = self.conn.execute(sql, [val for _, val in filters])
+        columns = [desc[0] for desc in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,75 @@
+''' Persistent manifest of examined run directories used for incremental collection.
+    Each run directory is keyed by name and stores a fingerprint of its files with
+    the parsed results or failure verdict from the last time it was examined.
+'''
+# std imports
+from os import replace, stat
+from os.path import exists, join as path_join
+import json
+
+# local imports
+from failures import RunFailure
+
+
+# bump this whenever the validation rules or parsed record format change, so old
+# manifests are discarded rather than trusted
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+FINGERPRINT_FILES = ['results.json', 'std.err', 'std.out']
+
+
+def _stat_fingerprint(fpath):
+    try:
+        info = stat(fpath)
+    except FileNotFoundError:
+        return None
+    return [info.st_mtime_ns, info.st_size]
+
+
+def fingerprint_run_dir(dirpath):
+    ''' The mtime and size of a run directory and the files that decide its
+        validity. The directory mtime changes when files such as
+        'hpctoolkit-measurements' are created or removed.
+    '''
+    return [_stat_fingerprint(dirpath)] + [_stat_fingerprint(path_join(dirpath, fname))
+        for fname in FINGERPRINT_FILES]
+
+
+def make_entry(fingerprint, is_dir, status, result, failure):
+    ''' Manifest entry for an examined run directory.
+    '''
+    return {'fingerprint': fingerprint, 'is_dir': is_dir, 'status': status, 'result': result,
+        'failure': failure}
+
+
+def entry_to_examined(entry):
+    ''' Inverse of `make_entry`. Returns the (is_dir, status, result, failure) tuple
+        the directory was examined as.
+    '''
+    failure = entry['failure']
+    if failure is not None:
+        failure = RunFailure(*failure)
+    return entry['is_dir'], entry['status'], entry['result'], failure
+
+
+def load_manifest(fpath):
+    ''' Read the manifest at `fpath`. A missing or out of date manifest is empty.
+    '''
+    if not exists(fpath):
+        return {}
+
+    with open(fpath, 'r') as fp:
+        obj = json.load(fp)
+    if obj.get('version') != MANIFEST_VERSION:
+        return {}
+    return obj['entries']
+
+
+def save_manifest(fpath, entries):
+    ''' Write the manifest to `fpath`. The file is replaced atomically so an
+        interrupted collection never leaves a truncated manifest behind.
+    '''
+    tmp_fpath = fpath + '.tmp'
+    with open(tmp_fpath, 'w') as fp:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, fp)
+    replace(tmp_fpath, fpath)
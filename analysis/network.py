@@ -0,0 +1,227 @@
+''' The dense network trained by `dense-nn.py` and `sweep-nn.py`, and how it is
+    trained and evaluated on whole-dataset tensors.
+'''
+# std imports
+from os import replace
+from time import perf_counter
+
+# tpl imports
+from alive_progress import alive_it
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.utils.data as data_utils
+
+# local imports
+from preprocessing import CounterNormalizer
+from ranking import ranking_metrics
+
+
+TARGETS = ['quartz Relative Time', 'ruby Relative Time']
+THROUGHPUT_BATCH_SIZE = 1024
+
+
+def split_indices(num_rows, test_size, generator=None):
+    ''' Hold out a random `test_size` fraction of `num_rows` rows.
+        Returns:
+            sorted (train_idx, test_idx) numpy arrays
+    '''
+    order = torch.randperm(num_rows, generator=generator).numpy()
+    num_test = int(round(num_rows * test_size))
+    return np.sort(order[num_test:]), np.sort(order[:num_test])
+
+
+def fit_normalizer(X, features, train_idx):
+    ''' A `CounterNormalizer` of every feature fit on the rows `train_idx` of `X`.
+        It transforms in place, so it is only given copies of rows.
+    '''
+    return CounterNormalizer(features, scale='all', copy=False).fit(X[train_idx])
+
+
+def normalized_rows(X, y, idx, normalizer):
+    ''' Tensors of the rows `idx` of the float32 matrices `X`, normalized by the
+        fitted `normalizer`, and `y`. Only those rows are read and copied, so a
+        memory-mapped `X` is never written to or read in full.
+    '''
+    return torch.from_numpy(normalizer.transform(X[idx])), torch.from_numpy(np.ascontiguousarray(y[idx]))
+
+
+def split_tensors(X, y, features, test_size, generator=None):
+    ''' Hold out a random `test_size` fraction of the rows of the float32 matrices
+        `X` and `y` and normalize both parts with a `CounterNormalizer` fit on the
+        other rows.
+        Returns:
+            (X_train, y_train, X_test, y_test, normalizer) where normalizer is the
+            fitted CounterNormalizer
+    '''
+    train_idx, test_idx = split_indices(len(X), test_size, generator)
+    normalizer = fit_normalizer(X, features, train_idx)
+    return (*normalized_rows(X, y, train_idx, normalizer), *normalized_rows(X, y, test_idx, normalizer),
+        normalizer)
+
+
+def regression_metrics(y_true, y_pred):
+    ''' Return a dict of metrics based on y_true and y_pred results.
+    '''
+    from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, explained_variance_score
+    return {
+        'r2': r2_score(y_true, y_pred),
+        'mse': mean_squared_error(y_true, y_pred),
+        'mae': mean_absolute_error(y_true, y_pred),
+        'evs': explained_variance_score(y_true, y_pred),
+        **ranking_metrics(y_true, y_pred)
+    }
+
+
+class Net(nn.Module):
+    def __init__(self, hidden_sizes=(128, 64), num_outputs=2):
+        super(Net, self).__init__()
+
+        self.fc_layers_ = nn.Sequential(*[nn.LazyLinear(hs) for hs in hidden_sizes], nn.LazyLinear(num_outputs))
+
+    def forward(self, x):
+        for layer in self.fc_layers_[:-1]:
+            x = F.relu( layer(x) )
+        
+        x = self.fc_layers_[-1](x)
+        return x
+
+
+def tensor_batches(X, y, batch_size, generator=None):
+    ''' Shuffled batches of the whole-dataset tensors `X` and `y`. The rows are
+        shuffled with one gather per epoch and the batches are slices of it, so
+        there is no per-sample indexing as with a DataLoader.
+    '''
+    order = torch.randperm(len(X), generator=generator)
+    X, y = X[order], y[order]
+    for start in range(0, len(X), batch_size):
+        yield X[start:start + batch_size], y[start:start + batch_size]
+
+
+def train_regression(X, y, model, learning_rate=0.001, epochs=5, batch_size=4, in_memory=False, generator=None,
+    rank=0, world_size=1, on_epoch=None, verbose=True, optimizer=None, start_epoch=0):
+    ''' Train `model` on the tensors `X` and `y`. With `in_memory` the batches are
+        sliced from the tensors and the loss is only read once per epoch.
+        Otherwise they come from a DataLoader and a progress bar shows the loss
+        of every step. The time and throughput of each epoch are printed if
+        `verbose`. With a `world_size` above 1, `model` is wrapped in
+        DistributedDataParallel and `X` and `y` are the shard of the rows of
+        process `rank`. Every shard must have the same number of rows, so all
+        processes take the same number of steps. The loss and throughput are
+        over all shards. `on_epoch(epoch, loss)` is called after every epoch and
+        training stops early if it returns True. A resumed training passes its
+        restored `optimizer` and the `start_epoch` to continue from.
+    '''
+    criterion = nn.L1Loss()
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate) if optimizer is None else optimizer
+    loader = None
+    if not in_memory:
+        loader = data_utils.DataLoader(data_utils.TensorDataset(X, y), batch_size=batch_size, shuffle=True,
+            generator=generator)
+
+    for epoch in range(start_epoch, epochs):
+        model.train()
+        start = perf_counter()
+        running_loss, num_steps = torch.zeros(()), 0
+        if in_memory:
+            batches = tensor_batches(X, y, batch_size, generator=generator)
+        else:
+            batches = loader if rank != 0 or not verbose else alive_it(loader, title='Epoch {}'.format(epoch),
+                force_tty=True, theme='smooth', receipt=True, receipt_text=True)
+        for inputs, targets in batches:
+
+            optimizer.zero_grad()
+
+            outputs = model(inputs)
+            loss = criterion(outputs, targets)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.detach()
+            num_steps += 1
+            if not in_memory and rank == 0 and verbose:
+                batches.text = 'Loss: {:.3f}'.format(running_loss.item() / num_steps)
+
+        totals = torch.stack([running_loss, torch.tensor(float(num_steps)), torch.tensor(float(len(X)))])
+        if world_size > 1:
+            dist.all_reduce(totals)
+        seconds, loss = perf_counter() - start, (totals[0] / totals[1]).item()
+        if rank == 0 and verbose:
+            print('Epoch {}: loss {:.3f}, {:.3f}s, {:,.0f} samples/sec'.format(epoch, loss, seconds,
+                totals[2].item() / seconds))
+        if on_epoch is not None and on_epoch(epoch, loss):
+            break
+
+
+def predict(model, X, batch_size=4096):
+    ''' Predictions of `model` for every row of `X`, in batches without gradients.
+    '''
+    model.eval()
+    with torch.no_grad():
+        return torch.cat([model(X[start:start + batch_size]) for start in range(0, len(X), batch_size)])
+
+
+class NetPredictor:
+    ''' A trained `Net` together with the `CounterNormalizer` fit on its training
+        rows, so predictions from raw features are scaled exactly as in training.
+        This is what `dense-nn.py --save-model` pickles.
+    '''
+
+    def __init__(self, net, normalizer, features, targets):
+        self.net = net
+        # never normalize the caller's features in place
+        self.normalizer = normalizer.set_params(copy=True)
+        self.features, self.targets = list(features), list(targets)
+
+    def predict(self, X):
+        ''' Predicted targets for the raw features `X`, a matrix with the columns
+            `features` or a frame that has them.
+        '''
+        if hasattr(X, 'columns'):
+            X = X[self.features].to_numpy(dtype=np.float32)
+        X = torch.from_numpy(self.normalizer.transform(X))
+        return predict(self.net, X).numpy()
+
+
+class EarlyStopping:
+    ''' Tracks the validation loss of every epoch and keeps the weights of the
+        best one. `step` says to stop once `patience` epochs in a row have not
+        improved on the best loss; without a `patience` it never does.
+    '''
+
+    def __init__(self, patience=None):
+        self.patience = patience
+        self.best_loss, self.best_epoch, self.best_weights = float('inf'), -1, None
+        self.stopped = False
+
+    def step(self, epoch, loss, model):
+        if loss < self.best_loss:
+            self.best_loss, self.best_epoch = loss, epoch
+            self.best_weights = {name: value.detach().clone() for name, value in model.state_dict().items()}
+        self.stopped = self.patience is not None and epoch - self.best_epoch >= self.patience
+        return self.stopped
+
+    def state_dict(self):
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch, 'best_weights': self.best_weights,
+            'stopped': self.stopped}
+
+    def load_state_dict(self, state):
+        self.best_loss, self.best_epoch = state['best_loss'], state['best_epoch']
+        self.best_weights, self.stopped = state['best_weights'], state['stopped']
+
+
+def save_checkpoint(fpath, **state):
+    ''' Save `state` to `fpath` with torch.save. The file is replaced in one step,
+        so a job killed while saving keeps its previous checkpoint.
+    '''
+    tmp_fpath = fpath + '.tmp'
+    torch.save(state, tmp_fpath)
+    replace(tmp_fpath, fpath)
+
+
+def load_checkpoint(fpath):
+    ''' The state saved by `save_checkpoint` to `fpath`. '''
+    return torch.load(fpath, weights_only=True)
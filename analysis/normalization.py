@@ -0,0 +1,182 @@
+''' Normalize the counters and inputs of datasets from different systems so they
+    can be combined. What to normalize is described by a table of rules (see
+    DEFAULT_RULES), which can also be loaded from a json file. The rules are
+    compiled once for each system and set of dataset columns into a plan that
+    renames, derives and fills every counter in one pass.
+'''
+# std imports
+from collections import namedtuple
+from functools import reduce
+from hashlib import sha1
+from operator import add
+from threading import Lock
+import json
+
+
+'''
+PAPI_BR_INS,PAPI_LD_INS,PAPI_SR_INS,PAPI_TOT_INS,PAPI_L1_LDM,PAPI_L1_STM,PAPI_L2_LDM,
+PAPI_L2_STM,EPT,FP_ARITH:SCALAR_SINGLE,FP_ARITH:SCALAR_DOUBLE,ARITH,IO Bytes Read,IO Bytes Written,
+PAPI_MEM_WCY,REALTIME (sec)
+'''
+
+'''
+~PAPI_BR_INS ~PAPI_TOT_INS
+amd64_fam17h_zen2::LS_DISPATCH:STORE_DISPATCH amd64_fam17h_zen2::LS_DISPATCH:LD_DISPATCH
+perf::L1-DCACHE-LOAD-MISSES perf::L1-ICACHE-LOAD-MISSES
+perf::STALLED-CYCLES-FRONTEND perf::STALLED-CYCLES-BACKEND 
+IO REALTIME
+gpu=amd
+'''
+
+
+'''
+perf::BRANCH-INSTRUCTIONS power9::PM_LD_CMPL power9::PM_ST_CMPL perf::INSTRUCTIONS
+power9::PM_LD_MISS_L1 power9::PM_ST_MISS_L1 power9::PM_L2_ST_MISS power9::PM_L2_LD_MISS
+PAPI_INT_INS
+PAPI_FP_INS
+perf::STALLED-CYCLES-FRONTEND perf::STALLED-CYCLES-BACKEND
+IO REALTIME
+gpu=nvidia
+'''
+
+# Rules for normalizing counters and inputs. The rules only match on counter
+# names, so a new system is handled by adding the names of its counters here (or
+# to a json rules file) without touching the code.
+DEFAULT_RULES = {
+    # removed from counter names. i.e. clx::ARITH and bdw_ep::ARITH represent the
+    # same counter on Ruby and Quartz, respectively
+    'prefixes': ['clx::', 'bdw_ep::'],
+    # counters that have a different name on some systems, as {name: common name}
+    'equivalents': {
+        'amd64_fam17h_zen2::LS_DISPATCH:STORE_DISPATCH': 'PAPI_SR_INS',
+        'amd64_fam17h_zen2::LS_DISPATCH:LD_DISPATCH': 'PAPI_LD_INS',
+        'perf::BRANCH-INSTRUCTIONS': 'PAPI_BR_INS',
+        'power9::PM_LD_CMPL': 'PAPI_LD_INS',
+        'power9::PM_ST_CMPL': 'PAPI_SR_INS',
+        'perf::INSTRUCTIONS': 'PAPI_TOT_INS',
+        'power9::PM_LD_MISS_L1': 'PAPI_L1_LDM',
+        'power9::PM_ST_MISS_L1': 'PAPI_L1_STM',
+        'power9::PM_L2_ST_MISS': 'PAPI_L2_STM',
+        'power9::PM_L2_LD_MISS': 'PAPI_L2_LDM',
+        'PAPI_FP_INS': 'FP_ARITH:SCALAR_DOUBLE',
+        'PAPI_INT_INS': 'ARITH',
+    },
+    # counters computed as the sum of other counters on systems that have all of
+    # them. The summed counters are dropped.
+    'derived': {
+        'PAPI_MEM_WCY': ['perf::STALLED-CYCLES-FRONTEND', 'perf::STALLED-CYCLES-BACKEND'],
+        'PAPI_L1_LDM': ['perf::L1-DCACHE-LOAD-MISSES', 'perf::L1-ICACHE-LOAD-MISSES'],
+    },
+    # counters a system cannot measure, as {system: counters}. They are set to
+    # 'fill' when the system's dataset does not have them.
+    'gaps': {
+        'corona': ['PAPI_L1_STM', 'PAPI_L2_LDM', 'PAPI_L2_STM', 'EPT', 'FP_ARITH:SCALAR_SINGLE',
+            'FP_ARITH:SCALAR_DOUBLE', 'ARITH'],
+        'lassen': ['EPT', 'FP_ARITH:SCALAR_SINGLE'],
+    },
+    'fill': -1,
+    # input arguments that only select a device, removed as {app: {system: args}}
+    # so runs on different systems share their inputs
+    'device_args': {
+        'laghos': {'corona': ['-d hip'], 'lassen': ['-d cuda']},
+    },
+}
+
+
+NormalizationPlan = namedtuple('NormalizationPlan', ['drop', 'columns', 'derived', 'fill'])
+NormalizationPlan.__doc__ = ''' Compiled normalization for one set of columns. `drop` are removed,
+    the rest are renamed to `columns`, then `derived` (name, sources) are added
+    followed by the `fill` columns.
+'''
+
+
+def load_rules(fpath):
+    ''' Read normalization rules from a json file. Keys it does not have are taken
+        from DEFAULT_RULES.
+    '''
+    with open(fpath, 'r') as fp:
+        return {**DEFAULT_RULES, **json.load(fp)}
+
+
+def rules_hash(rules):
+    ''' Hash identifying `rules`, which changes whenever any rule changes.
+    '''
+    return sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _common_name(col, rules):
+    for pref in rules['prefixes']:
+        col = col.replace(pref, '', 1)
+    return col.rstrip()
+
+
+def compile_plan(columns, machine, rules=DEFAULT_RULES):
+    ''' Compile `rules` into a plan for a dataset from `machine` with `columns`.
+    '''
+    stripped = {col: _common_name(col, rules) for col in columns}
+    present = set(stripped.values())
+
+    derived = [(name, [col for col in columns if stripped[col] in sources])
+        for name, sources in rules['derived'].items() if all(src in present for src in sources)]
+    drop = [col for _, sources in derived for col in sources]
+
+    renamed = [rules['equivalents'].get(stripped[col], stripped[col]) for col in columns if col not in drop]
+    produced = set(renamed) | {name for name, _ in derived}
+    fill = [col for col in rules['gaps'].get(machine, []) if col not in produced]
+    return NormalizationPlan(drop, renamed, derived, fill)
+
+
+_plans = {}
+_plans_lock = Lock()
+
+
+def get_plan(columns, machine, rules=DEFAULT_RULES):
+    ''' `compile_plan` cached on the column signature, system and rules. Datasets
+        from the same system share a plan, so the rules are only compiled once
+        per system.
+    '''
+    key = (tuple(columns), machine, rules_hash(rules))
+    with _plans_lock:
+        if key not in _plans:
+            _plans[key] = compile_plan(list(columns), machine, rules)
+        return _plans[key]
+
+
+def get_unique_col(df, col='machine'):
+    ''' get machine from dataframe '''
+    vals = df[col].unique()
+    assert len(vals) == 1
+    return str(vals[0])
+
+
+def normalize_columns(df, rules=DEFAULT_RULES):
+    ''' Some of the counter columns are the same thing but have different names
+        on different systems. i.e. clx::ARITH and bdw_ep::ARITH represent the
+        same counter on Ruby and Quartz, respectively. This will adjust the 
+        column names to fix this in `df` following `rules`, derive counters a
+        system does not have and fill the ones it cannot measure. Changes
+        columns in-place.
+    '''
+    plan = get_plan(df.columns, get_unique_col(df, col='machine'), rules)
+
+    derived = {name: reduce(add, (df[col] for col in sources)) for name, sources in plan.derived}
+    if plan.drop:
+        df.drop(columns=plan.drop, inplace=True)
+    df.columns = plan.columns
+    for name, values in derived.items():
+        df[name] = values
+    for col in plan.fill:
+        df[col] = rules['fill']
+
+
+def normalize_inputs(df, rules=DEFAULT_RULES):
+    ''' Remove the arguments in rules['device_args'] for the app and system of
+        `df` from its inputs. Changes the 'args' column in-place.
+    '''
+    MACHINE = get_unique_col(df, col='machine')
+    APP = get_unique_col(df, col='app')
+
+    if APP in rules['device_args']:
+        for arg in rules['device_args'][APP].get(MACHINE, []):
+            df['args'] = df['args'].str.replace(arg, '', regex=False)
+        df['args'] = df['args'].str.strip()
@@ -0,0 +1,72 @@
+''' Preprocessing of the regression features shared by the model scripts. The
+    transformer is fit on training rows only and is pickled together with the
+    model it feeds, so predictions reuse exactly the same scaling.
+'''
+# tpl imports
+import numpy as np
+from sklearn.base import BaseEstimator, OneToOneFeatureMixin, TransformerMixin
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils.validation import check_is_fitted
+
+
+# counters divided by PAPI_TOT_INS to get per instruction rates
+BY_INST = ['FP_ARITH:SCALAR_DOUBLE', 'PAPI_BR_INS', 'FP_ARITH:SCALAR_SINGLE', 'PAPI_SR_INS', 'ARITH', 'PAPI_LD_INS']
+# counters and runtimes standardized by default
+SCALE_COLS = ['PAPI_L2_LDM', 'PAPI_L2_STM', 'IO Bytes Read', 'IO Bytes Written', 'PAPI_MEM_WCY', 'PAPI_L1_LDM',
+    'PAPI_L1_STM', 'REALTIME (sec)', 'Overhead']
+
+
+class CounterNormalizer(OneToOneFeatureMixin, TransformerMixin, BaseEstimator):
+    ''' Divide the `by_inst` counters by PAPI_TOT_INS and standardize the `scale`
+        columns, or every column if `scale` is 'all'. Named columns missing from
+        the data are skipped. `features` names the columns of matrices; frames
+        use their own column names. Transforms return float32 copies unless
+        `copy` is False and the input is already a float32 matrix.
+    '''
+
+    def __init__(self, features=None, by_inst=tuple(BY_INST), scale=tuple(SCALE_COLS), copy=True):
+        self.features = features
+        self.by_inst = by_inst
+        self.scale = scale
+        self.copy = copy
+
+    def _column_names(self, X):
+        if hasattr(X, 'columns'):
+            return [str(col) for col in X.columns]
+        if self.features is None:
+            raise ValueError('CounterNormalizer needs `features` to transform a matrix without column names.')
+        if len(self.features) != X.shape[1]:
+            raise ValueError('Got {} features for a matrix with {} columns.'.format(len(self.features), X.shape[1]))
+        return list(self.features)
+
+    def _ratios(self, X, copy):
+        X = np.array(X, dtype=np.float32, order='C') if copy else np.asarray(X, dtype=np.float32, order='C')
+        if len(self.ratio_idx_):
+            X[:, self.ratio_idx_] /= X[:, [self.total_idx_]]
+        return X
+
+    def fit(self, X, y=None):
+        names = self._column_names(X)
+        col = {name: idx for idx, name in enumerate(names)}
+        if hasattr(X, 'columns'):
+            self.feature_names_in_ = np.asarray(names, dtype=object)
+        self.n_features_in_ = len(names)
+
+        self.total_idx_ = col.get('PAPI_TOT_INS')
+        self.ratio_idx_ = [col[name] for name in self.by_inst if name in col] if self.total_idx_ is not None else []
+        scale = names if isinstance(self.scale, str) and self.scale == 'all' else self.scale
+        self.scale_idx_ = [col[name] for name in scale if name in col]
+
+        self.scaler_ = StandardScaler()
+        if len(self.scale_idx_):
+            self.scaler_.fit(self._ratios(X, copy=True)[:, self.scale_idx_])
+        return self
+
+    def transform(self, X):
+        check_is_fitted(self, 'scaler_')
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError('Expected {} features, got {}.'.format(self.n_features_in_, X.shape[1]))
+        X = self._ratios(X, copy=self.copy)
+        if len(self.scale_idx_):
+            X[:, self.scale_idx_] = self.scaler_.transform(X[:, self.scale_idx_])
+        return X
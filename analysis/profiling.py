@@ -0,0 +1,207 @@
+''' Stage and per-directory profiling for the collection pipeline. Stages are
+    timed in the main process with the bytes they read and the peak memory of
+    the main process during them. Work on single run directories is split into
+    named steps that are timed in whichever process examines the directory, and
+    worker processes report their own peak memory.
+'''
+# std imports
+from contextlib import contextmanager, nullcontext
+from os import getpid
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from time import perf_counter
+import json
+
+
+# steps recorded by `timed` in this process, or None when not profiling
+_active_steps = None
+
+
+@contextmanager
+def timed(name, nbytes=0):
+    ''' Time a step of examining one run directory. The yielded dict's 'bytes' can
+        be set if the size read is not known up front. Does nothing unless called
+        under `call_profiled`.
+    '''
+    info = {'bytes': nbytes}
+    if _active_steps is None:
+        yield info
+        return
+
+    start = perf_counter()
+    try:
+        yield info
+    finally:
+        _active_steps.append((name, start, perf_counter() - start, info['bytes']))
+
+
+def call_profiled(func, *args):
+    ''' Call `func(*args)` and record the steps it times. Module level, so it can be
+        handed to a process pool with `functools.partial`.
+        Returns:
+            (result, steps, pid, peak_rss_mb) where steps is a list of (name, start,
+            seconds, bytes) and peak_rss_mb is the peak memory of this process.
+    '''
+    global _active_steps
+    _active_steps = []
+    try:
+        start = perf_counter()
+        result = func(*args)
+        _active_steps.append(('total', start, perf_counter() - start, 0))
+        return result, _active_steps, getpid(), peak_rss_mb()
+    finally:
+        _active_steps = None
+
+
+def stage(profiler, name):
+    ''' `profiler.stage(name)` or a no-op context if `profiler` is None.
+    '''
+    return nullcontext({}) if profiler is None else profiler.stage(name)
+
+
+def reset_peak_rss():
+    ''' Reset the peak memory of this process, so the next `peak_rss_mb` only
+        covers what runs after. Returns False if the OS cannot (only Linux can).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    ''' Peak memory of this process since the last `reset_peak_rss`, or over its
+        lifetime where that is not supported.
+    '''
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _children_peak_rss_mb():
+    ''' Peak memory of the largest child process that has finished.
+    '''
+    return getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+class PipelineProfiler:
+    ''' Records the stages of a collection and the steps of every run directory.
+    '''
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages, self.dirs, self.events = [], [], []
+        # peaks of the stages that are open, innermost last, and of every worker process
+        self.open_stages, self.worker_peaks = [], {}
+        self.peak_rss = 0.0
+
+    def _event(self, name, start, seconds, pid, args):
+        self.events.append({'name': name, 'ph': 'X', 'ts': (start - self.start) * 1e6, 'dur': seconds * 1e6,
+            'pid': pid, 'tid': pid, 'args': args})
+
+    def _fold_peak(self, peak):
+        ''' Count `peak` towards every open stage and the whole run.
+        '''
+        self.peak_rss = max(self.peak_rss, peak)
+        for open_stage in self.open_stages:
+            open_stage['peak'] = max(open_stage['peak'], peak)
+
+    @contextmanager
+    def stage(self, name):
+        ''' Time a stage and measure the peak memory of the main process during it,
+            and of the worker processes that examined directories in it. The
+            yielded dict can be given a 'bytes' count.
+        '''
+        info = {'bytes': 0}
+        # the peak so far still counts for the enclosing stages before it is reset
+        self._fold_peak(peak_rss_mb())
+        reset_peak_rss()
+        self.open_stages.append({'peak': 0.0, 'workers': {}})
+        start = perf_counter()
+        try:
+            yield info
+        finally:
+            seconds = perf_counter() - start
+            self._fold_peak(peak_rss_mb())
+            peaks = self.open_stages.pop()
+            self.stages.append({'name': name, 'seconds': seconds, 'bytes': info['bytes'],
+                'peak_rss_mb': peaks['peak'], 'num_workers': len(peaks['workers']),
+                'worker_peak_rss_mb': max(peaks['workers'].values(), default=0.0),
+                'workers_total_peak_rss_mb': sum(peaks['workers'].values())})
+            self._event(name, start, seconds, getpid(), {'bytes': info['bytes']})
+
+    def add_dir(self, dirname, steps, pid, peak_rss_mb=0.0):
+        ''' Record the steps and worker peak memory returned by `call_profiled` for
+            run directory `dirname`.
+        '''
+        if pid != getpid():
+            self.worker_peaks[pid] = max(self.worker_peaks.get(pid, 0.0), peak_rss_mb)
+            for open_stage in self.open_stages:
+                open_stage['workers'][pid] = self.worker_peaks[pid]
+        timings = {}
+        for name, start, seconds, nbytes in steps:
+            timings[name] = {'seconds': seconds, 'bytes': nbytes}
+            self._event(name, start, seconds, pid, {'dir': dirname, 'bytes': nbytes})
+        total = timings.pop('total', {'seconds': 0.0})
+        self.dirs.append({'dir': dirname, 'seconds': total['seconds'],
+            'bytes': sum(step['bytes'] for step in timings.values()), 'steps': timings})
+        return self.dirs[-1]['bytes']
+
+    def report(self, top=10):
+        ''' Summary of the profile with the `top` slowest run directories.
+        '''
+        steps = {}
+        for info in self.dirs:
+            for name, timing in info['steps'].items():
+                total = steps.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                total['count'] += 1
+                total['seconds'] += timing['seconds']
+                total['bytes'] += timing['bytes']
+
+        return {
+            'total_seconds': perf_counter() - self.start,
+            'peak_rss_mb': max(self.peak_rss, peak_rss_mb()),
+            # finished pool workers are also counted by the OS as children
+            'worker_peak_rss_mb': max(list(self.worker_peaks.values()) + [_children_peak_rss_mb()])
+                if self.worker_peaks else 0.0,
+            'stages': self.stages,
+            'num_dirs': len(self.dirs),
+            'dir_steps': steps,
+            'slowest_dirs': sorted(self.dirs, key=lambda x: x['seconds'], reverse=True)[:top],
+        }
+
+    def write(self, prefix, top=10):
+        ''' Write the report to '<prefix>.json' and a Chrome trace (viewable in
+            chrome://tracing or Perfetto) to '<prefix>.trace.json'.
+        '''
+        report = self.report(top=top)
+        with open(prefix + '.json', 'w') as fp:
+            json.dump(report, fp, indent=2)
+        with open(prefix + '.trace.json', 'w') as fp:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fp)
+        return report
+
+    def print_summary(self, report):
+        workers = ''
+        if report['worker_peak_rss_mb']:
+            workers = ', {:.1f} MB peak RSS of a worker'.format(report['worker_peak_rss_mb'])
+        print('Profile: {:.3f}s total, {:.1f} MB peak RSS{}.'.format(report['total_seconds'], report['peak_rss_mb'],
+            workers))
+        for info in report['stages']:
+            workers = ''
+            if info['num_workers']:
+                workers = ', {} workers up to {:.1f} MB peak, {:.1f} MB together'.format(info['num_workers'],
+                    info['worker_peak_rss_mb'], info['workers_total_peak_rss_mb'])
+            print('  stage {:<14} {:>9.3f}s {:>14,} bytes {:>9.1f} MB peak{}'.format(info['name'], info['seconds'],
+                info['bytes'], info['peak_rss_mb'], workers))
+        for name, info in report['dir_steps'].items():
+            print('  step  {:<14} {:>9.3f}s {:>14,} bytes in {} dirs'.format(name, info['seconds'], info['bytes'],
+                info['count']))
+        for info in report['slowest_dirs']:
+            print('  slow  {} {:.3f}s {:,} bytes'.format(info['dir'], info['seconds'], info['bytes']))
@@ -0,0 +1,48 @@
+''' Query the catalog of failed runs written by collect-dataset.py and
+    collect-all.py with --catalog. For instance, to list the laghos inputs that
+    segfault on corona:
+
+        python3 query-failures.py --catalog failures.db -m corona -a laghos -k segfault --by-input
+'''
+# std imports
+from argparse import ArgumentParser
+from collections import Counter
+
+# local imports
+from failures import FailureCatalog
+
+
+def parse_args():
+    ''' Parses input arguments
+    '''
+    parser = ArgumentParser()
+    parser.add_argument('--catalog', type=str, required=True, help='failure catalog file')
+    parser.add_argument('-m', '--machine', type=str, help='only failures on this machine')
+    parser.add_argument('-a', '--app', type=str, help='only failures of this app')
+    parser.add_argument('-k', '--kind', type=str, help='only failures of this kind (i.e. segfault, time-limit)')
+    parser.add_argument('-i', '--input-args', type=str, help='sqlite LIKE pattern the input args must match')
+    parser.add_argument('--by-input', action='store_true', help='count failures per machine, app, kind and input ' +
+        'instead of listing each run')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    catalog = FailureCatalog(args.catalog)
+    failures = catalog.query(machine=args.machine, app=args.app, kind=args.kind, input_args=args.input_args)
+    catalog.close()
+
+    if args.by_input:
+        counts = Counter((row['machine'], row['app'], row['kind'], row['input_args']) for row in failures)
+        for (machine, app, kind, input_args), count in sorted(counts.items()):
+            print('{}\t{}\t{}\t{}\t\'{}\''.format(count, machine, app, kind, input_args))
+    else:
+        for row in failures:
+            print('{machine}\t{app}\t{kind}\t{name}\t\'{input_args}\''.format(**row))
+    print('{} failed runs.'.format(len(failures)))
+
+
+
+if __name__ == '__main__':
+    main()
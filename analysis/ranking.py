@@ -0,0 +1,85 @@
+''' Ranking metrics for predictions of a row of per-machine relative times. Each
+    row of `y_true` and `y_pred` orders the same machines, and the metrics check
+    how well the predicted order matches the actual one. They work on whole
+    matrices at once by comparing every pair of columns, and higher is better.
+    The scorers in SCORERS can be passed as the scoring of sklearn searches.
+'''
+# tpl imports
+import numpy as np
+from sklearn.metrics import get_scorer as get_sklearn_scorer, make_scorer
+
+
+def _pair_signs(y):
+    ''' Sign of y[:, i] - y[:, j] for every column pair i < j, one row per row of `y`.
+    '''
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y.reshape(-1, 1)
+    first, second = np.triu_indices(y.shape[1], k=1)
+    return np.sign(y[:, first] - y[:, second])
+
+
+def same_order_score(y_true, y_pred):
+    ''' Fraction of rows whose predicted values have exactly the same ranks, ties
+        included, as the actual values.
+    '''
+    return float(np.mean(np.all(_pair_signs(y_true) == _pair_signs(y_pred), axis=1)))
+
+
+def top1_score(y_true, y_pred):
+    ''' Fraction of rows where the predicted fastest (smallest) column is one of
+        the actual fastest columns.
+    '''
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    best = np.argmin(y_pred, axis=1)
+    return float(np.mean(y_true[np.arange(len(y_true)), best] == np.min(y_true, axis=1)))
+
+
+def pairwise_order_score(y_true, y_pred):
+    ''' Fraction of column pairs, over all rows, that the prediction orders the
+        same way as the actual values. A tie only matches a tie.
+    '''
+    return float(np.mean(_pair_signs(y_true) == _pair_signs(y_pred)))
+
+
+def kendall_tau_score(y_true, y_pred):
+    ''' Mean Kendall tau-b between the actual and predicted values of each row.
+        Rows that are all ties in either have no tau and are skipped; if every
+        row is, the score is nan.
+    '''
+    true_signs, pred_signs = _pair_signs(y_true), _pair_signs(y_pred)
+    denominator = np.sqrt(np.abs(true_signs).sum(axis=1) * np.abs(pred_signs).sum(axis=1))
+    concordance = (true_signs * pred_signs).sum(axis=1)
+    defined = denominator > 0
+    if not np.any(defined):
+        return float('nan')
+    return float(np.mean(concordance[defined] / denominator[defined]))
+
+
+def ranking_metrics(y_true, y_pred):
+    ''' Return a dict of ranking metrics based on y_true and y_pred results.
+    '''
+    return {name: metric(y_true, y_pred) for name, metric in METRICS.items()}
+
+
+METRICS = {
+    'sos': same_order_score,
+    'top1': top1_score,
+    'pairs': pairwise_order_score,
+    'tau': kendall_tau_score,
+}
+
+SCORERS = {
+    'same_order': make_scorer(same_order_score),
+    'top1': make_scorer(top1_score),
+    'pairwise_order': make_scorer(pairwise_order_score),
+    'kendall_tau': make_scorer(kendall_tau_score),
+}
+
+
+def get_scorer(scoring):
+    ''' The scorer named `scoring` in SCORERS or else sklearn's `get_scorer(scoring)`.
+    '''
+    if isinstance(scoring, str) and scoring in SCORERS:
+        return SCORERS[scoring]
+    return get_sklearn_scorer(scoring)
@@ -0,0 +1,455 @@
+''' Parallel model search. Every (model, parameters, fold) fit of a search is a
+    separate task, so all candidate models and their cross-validation folds
+    share one pool of processes. Settings are either all cross-validated in full
+    or narrowed down by successive halving within a time budget. Each task is
+    limited to a fixed number of threads and records its fit and predict time
+    and peak memory. The results form a leaderboard that can be saved and merged
+    with earlier searches. A chosen model is evaluated by holding out each
+    machine or app in turn, with those folds also run in parallel.
+'''
+# std imports
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from os.path import exists, splitext
+from time import perf_counter, time
+import json
+
+# tpl imports
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import GroupKFold, KFold, ParameterGrid
+from sklearn.pipeline import Pipeline
+from threadpoolctl import threadpool_limits
+
+# local imports
+from cache import array_hash, make_key
+from profiling import peak_rss_mb, reset_peak_rss
+from ranking import get_scorer, ranking_metrics
+
+
+ModelCandidate = namedtuple('ModelCandidate', ['name', 'estimator', 'grid'])
+ModelCandidate.__doc__ = ''' A model to search: an unfitted `estimator` and the parameter `grid` to try
+    on it, in the format of sklearn's ParameterGrid.
+'''
+
+DEFAULT_SCORING = 'neg_mean_absolute_error'
+LEADERBOARD_COLUMNS = ['dataset', 'scoring', 'model', 'params', 'rung', 'resource', 'mean_score', 'std_score',
+    'folds', 'fit_seconds', 'predict_seconds', 'peak_mb', 'threads', 'recorded']
+
+
+def get_candidates(names=None):
+    ''' The models searched by default, or only those in `names`.
+    '''
+    from sklearn.dummy import DummyRegressor
+    from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+    from sklearn.linear_model import LinearRegression
+    from sklearn.neighbors import KNeighborsRegressor
+    from sklearn.neural_network import MLPRegressor
+    from sklearn.tree import DecisionTreeRegressor
+    from xgboost import XGBRegressor
+
+    candidates = [
+        ModelCandidate('DummyRegressor', DummyRegressor(), {'strategy': ['mean', 'median']}),
+        ModelCandidate('LinearRegression', LinearRegression(), {'fit_intercept': [True, False]}),
+        ModelCandidate('DecisionTreeRegressor', DecisionTreeRegressor(),
+            {'max_depth': [1, 2, 4, 8, 12], 'criterion': ['squared_error', 'absolute_error']}),
+        ModelCandidate('RandomForestRegressor', RandomForestRegressor(),
+            {'n_estimators': [10, 50, 100], 'criterion': ['squared_error', 'absolute_error', 'poisson']}),
+        ModelCandidate('ExtraTreesRegressor', ExtraTreesRegressor(),
+            {'n_estimators': [10, 50, 100], 'criterion': ['squared_error', 'absolute_error', 'poisson']}),
+        ModelCandidate('KNeighborsRegressor', KNeighborsRegressor(),
+            {'n_neighbors': [1, 3, 5, 10], 'weights': ['uniform', 'distance']}),
+        ModelCandidate('MLPRegressor', MLPRegressor(max_iter=1000),
+            {'hidden_layer_sizes': [(64,), (128, 64)], 'alpha': [1e-4, 1e-2]}),
+        ModelCandidate('XGBRegressor', XGBRegressor(),
+            {'n_estimators': [1, 2, 10, 50, 100], 'eta': [0.3, 0.1], 'booster': ['gbtree', 'gblinear', 'dart']}),
+    ]
+    if names is None:
+        return candidates
+    return [candidate for candidate in candidates if candidate.name in names]
+
+
+# the training data of a worker process, set once by `_init_worker`
+_X, _y = None, None
+
+
+def _init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def _rows(data, idx):
+    return data.iloc[idx] if isinstance(data, (pd.DataFrame, pd.Series)) else data[idx]
+
+
+def _with_threads(estimator, threads):
+    model = estimator.steps[-1][1] if isinstance(estimator, Pipeline) else estimator
+    if 'n_jobs' in model.get_params():
+        model.set_params(n_jobs=threads)
+    return estimator
+
+
+def with_preprocessing(candidates, preprocess, memory=None):
+    ''' `candidates` with each estimator preceded by a clone of the transformer
+        `preprocess` in a pipeline, so it is fit on the training rows of every
+        fit and saved with the refit models. With a joblib `memory` (or cache
+        directory) a transformer fit on the same rows is reused by every
+        parameter setting instead of being fit again.
+    '''
+    return [ModelCandidate(candidate.name,
+        Pipeline([('preprocess', clone(preprocess)), ('model', candidate.estimator)], memory=memory),
+        {'model__' + key: vals for key, vals in candidate.grid.items()}) for candidate in candidates]
+
+
+def _param_name(estimator, name):
+    ''' `name` or the name of the same parameter of a pipeline's model. '''
+    params = estimator.get_params()
+    return name if name in params or 'model__' + name not in params else 'model__' + name
+
+
+def fit_and_score(estimator, params, train_idx, test_idx, scoring, threads):
+    ''' Fit a clone of `estimator` with `params` on the `train_idx` rows of the
+        worker's data and score it on the `test_idx` rows. Native thread pools
+        (BLAS, OpenMP) and the estimator's n_jobs are limited to `threads`. Peak
+        memory is the peak RSS of the process running the task, which is reset
+        before the task where the OS supports it (see `profiling`) and read after
+        the timed fit and predict.
+        Returns:
+            (score, fit_seconds, predict_seconds, peak_mb)
+    '''
+    estimator = _with_threads(clone(estimator).set_params(**params), threads)
+    scorer = get_scorer(scoring)
+
+    reset_peak_rss()
+    with threadpool_limits(limits=threads):
+        start = perf_counter()
+        estimator.fit(_rows(_X, train_idx), _rows(_y, train_idx))
+        fit_seconds = perf_counter() - start
+
+        start = perf_counter()
+        score = scorer(estimator, _rows(_X, test_idx), _rows(_y, test_idx))
+        predict_seconds = perf_counter() - start
+    return score, fit_seconds, predict_seconds, peak_rss_mb()
+
+
+def refit(estimator, params, threads):
+    ''' Fit a clone of `estimator` with `params` on all of the worker's data. '''
+    estimator = _with_threads(clone(estimator).set_params(**params), threads)
+    with threadpool_limits(limits=threads):
+        return estimator.fit(_X, _y)
+
+
+def _run_tasks(executor, func, tasks, deadline=None):
+    ''' `func(*task)` for each of `tasks`, in order. Tasks that have not started
+        by the `perf_counter` time `deadline` are skipped and their result is None.
+    '''
+    if executor is None:
+        return [func(*task) if deadline is None or perf_counter() < deadline else None for task in tasks]
+
+    futures = [executor.submit(func, *task) for task in tasks]
+    done, not_done = wait(futures, timeout=None if deadline is None else max(0.0, deadline - perf_counter()))
+    for future in not_done:
+        future.cancel()
+    return [future.result() if future in done or not future.cancelled() else None for future in futures]
+
+
+SearchResult = namedtuple('SearchResult', ['leaderboard', 'best'])
+SearchResult.__doc__ = ''' `leaderboard` has a row per (model, params) sorted by rung and mean score
+    and `best` maps each model name to its (refit estimator, mean score, params).
+'''
+
+
+def _leaderboard_row(candidate, params, results, threads, rung=0, resource=''):
+    scores, fit_times, predict_times, peaks = zip(*results)
+    # model parameters are recorded without the pipeline's prefix
+    params = {key.replace('model__', '', 1): val for key, val in params.items()}
+    return {'model': candidate.name, 'params': json.dumps(params, sort_keys=True, default=str),
+        'rung': rung, 'resource': resource, 'mean_score': np.mean(scores), 'std_score': np.std(scores),
+        'folds': len(results), 'fit_seconds': np.mean(fit_times), 'predict_seconds': np.mean(predict_times),
+        'peak_mb': np.max(peaks), 'threads': threads}
+
+
+def _search_result(executor, evaluated, threads):
+    ''' Refit the best setting of each model in parallel. `evaluated` is a list of
+        (candidate, params, row) for every setting, where params are what the
+        setting is refit with.
+    '''
+    leaderboard = pd.DataFrame([row for _, _, row in evaluated]).sort_values(['rung', 'mean_score'],
+        ascending=False, ignore_index=True)
+
+    best = {}
+    for candidate, params, row in evaluated:
+        current = best.get(candidate.name)
+        if current is None or (row['rung'], row['mean_score']) > (current[2]['rung'], current[2]['mean_score']):
+            best[candidate.name] = (candidate, params, row)
+
+    refits = _run_tasks(executor, refit, [(candidate.estimator, params, threads)
+        for candidate, params, _ in best.values()])
+    return SearchResult(leaderboard, {name: (estimator, row['mean_score'], params)
+        for (name, (_, params, row)), estimator in zip(best.items(), refits)})
+
+
+def _executor(X, y, jobs):
+    if jobs > 1:
+        return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(X, y))
+    _init_worker(X, y)
+    return nullcontext()
+
+
+def search_models(X, y, candidates, cv=5, scoring=DEFAULT_SCORING, jobs=1, threads=1):
+    ''' Cross-validate every parameter combination of every candidate and refit
+        the best parameters of each candidate on all of `X` and `y`. The fits run
+        on a pool of `jobs` processes with `threads` threads each. `scoring` is a
+        sklearn scorer name or one of `ranking.SCORERS`. Higher scores are
+        better, as with sklearn scorers.
+    '''
+    folds = list(KFold(n_splits=cv).split(X))
+    configs = [(candidate, params) for candidate in candidates for params in ParameterGrid(candidate.grid)]
+    tasks = [(candidate.estimator, params, train_idx, test_idx, scoring, threads) for candidate, params in configs
+        for train_idx, test_idx in folds]
+
+    with _executor(X, y, jobs) as executor:
+        results = _run_tasks(executor, fit_and_score, tasks)
+        evaluated = [(candidate, params, _leaderboard_row(candidate, params, results[idx * cv:(idx + 1) * cv],
+            threads)) for idx, (candidate, params) in enumerate(configs)]
+        return _search_result(executor, evaluated, threads)
+
+
+def halving_search(X, y, candidates, cv=5, scoring=DEFAULT_SCORING, jobs=1, threads=1, factor=3,
+    resource='n_samples', min_resource=None, max_resource=None, budget=None):
+    ''' Successive halving over every parameter setting of every candidate. All
+        settings are first cross-validated with a small amount of `resource`:
+        either 'n_samples' training rows per fold or a parameter such as
+        'n_estimators', which is then removed from the grids. Only the best
+        1/`factor` of the settings go on to the next rung, which gets `factor`
+        times as much of the resource, so poor settings are dropped after cheap
+        fits. If `budget` seconds of wall-clock time run out, then no more fits
+        are started and each model's setting from its highest finished rung is
+        refit. Otherwise the same as `search_models`.
+    '''
+    deadline = None if budget is None else perf_counter() + budget
+    folds = list(KFold(n_splits=cv).split(X))
+
+    if resource == 'n_samples':
+        # train on growing prefixes of a fixed shuffle of each fold
+        rng = np.random.RandomState(42)
+        folds = [(rng.permutation(train_idx), test_idx) for train_idx, test_idx in folds]
+        max_resource = min(len(train_idx) for train_idx, _ in folds) if max_resource is None else max_resource
+        configs = [(candidate, params) for candidate in candidates for params in ParameterGrid(candidate.grid)]
+    else:
+        resource = _param_name(candidates[0].estimator, resource)
+        for candidate in candidates:
+            if resource not in candidate.estimator.get_params():
+                raise ValueError('Model \'{}\' has no parameter \'{}\' to use as a resource.'.format(
+                    candidate.name, resource))
+        if max_resource is None:
+            max_resource = max(max(candidate.grid.get(resource, [0])) for candidate in candidates)
+        if max_resource <= 0:
+            raise ValueError('max_resource is needed if no grid has values of \'{}\'.'.format(resource))
+        configs = [(candidate, params) for candidate in candidates for params in
+            ParameterGrid({key: vals for key, vals in candidate.grid.items() if key != resource})]
+
+    # enough rungs to narrow the settings down to one, but never starting below
+    # the smallest resource (2 samples per fold as in sklearn, or 1 iteration)
+    smallest = 2 * cv if resource == 'n_samples' else 1
+    num_rungs = max(1, int(np.ceil(np.log(len(configs)) / np.log(factor))))
+    if min_resource is None:
+        min_resource = max(smallest, max_resource // factor ** (num_rungs - 1))
+
+    evaluated, survivors = {}, list(range(len(configs)))
+    with _executor(X, y, jobs) as executor:
+        for rung in range(num_rungs):
+            amount = int(max_resource if rung == num_rungs - 1 else min(max_resource, min_resource * factor ** rung))
+            tasks = []
+            for idx in survivors:
+                estimator, params = configs[idx][0].estimator, configs[idx][1]
+                for train_idx, test_idx in folds:
+                    if resource == 'n_samples':
+                        tasks.append((estimator, params, train_idx[:amount], test_idx, scoring, threads))
+                    else:
+                        tasks.append((estimator, {**params, resource: amount}, train_idx, test_idx, scoring, threads))
+            results = _run_tasks(executor, fit_and_score, tasks, deadline)
+
+            finished = []
+            for pos, idx in enumerate(survivors):
+                fold_results = results[pos * cv:(pos + 1) * cv]
+                if all(result is not None for result in fold_results):
+                    candidate, params = configs[idx]
+                    refit_params = params if resource == 'n_samples' else {**params, resource: amount}
+                    row = _leaderboard_row(candidate, params, fold_results, threads, rung,
+                        '{}={}'.format(resource, amount))
+                    evaluated[idx] = (candidate, refit_params, row)
+                    finished.append(idx)
+
+            if len(finished) < len(survivors) or amount >= max_resource:
+                break
+            finished.sort(key=lambda idx: evaluated[idx][2]['mean_score'], reverse=True)
+            survivors = finished[:max(1, len(finished) // factor)]
+
+        if not evaluated:
+            raise RuntimeError('The search budget of {}s ran out before any setting was evaluated.'.format(budget))
+        return _search_result(executor, list(evaluated.values()), threads)
+
+
+# index levels of a run group, whose rows on every machine share the same targets
+RUN_GROUP_LEVELS = ['app', 'args', 'ranks']
+DEFAULT_GROUP_SPLITS = 5
+
+Fold = namedtuple('Fold', ['by', 'held_out', 'part', 'train_idx', 'test_idx'])
+Fold.__doc__ = ''' Rows to train and test on. The test rows are those of the `held_out`
+    value of the index level `by`, e.g. one machine, in the `part`th split of
+    the run groups. No training row is of `held_out` or of a test row's group.
+'''
+
+
+def holdout_folds(index, by='machine', group_splits=DEFAULT_GROUP_SPLITS):
+    ''' Folds that hold out every value of the `by` level ('machine' or 'app') of
+        the MultiIndex `index` in turn. The runs of one input on every machine
+        share their targets, so no run of a test row's group (app, args and
+        ranks) is trained on either. If the held out value shares groups with
+        the others, as a machine does, then the groups are split into
+        `group_splits` parts and the value is tested on one part at a time.
+    '''
+    codes, values = pd.factorize(index.get_level_values(by).astype(str), sort=True)
+    if len(values) < 2:
+        raise ValueError('Cannot hold out one {} at a time with only {}.'.format(by, list(values)))
+    groups, _ = pd.MultiIndex.from_arrays([index.get_level_values(level) for level in RUN_GROUP_LEVELS]).factorize()
+
+    num_splits = min(group_splits, groups.max() + 1)
+    group_parts = np.zeros(len(groups), dtype=np.int64)
+    if num_splits >= 2:
+        for part, (_, test_idx) in enumerate(GroupKFold(n_splits=num_splits).split(groups, groups=groups)):
+            group_parts[test_idx] = part
+
+    folds = []
+    for code, value in enumerate(values):
+        held_out = codes == code
+        if not np.isin(groups[held_out], groups[~held_out]).any():
+            folds.append(Fold(by, value, 0, np.flatnonzero(~held_out), np.flatnonzero(held_out)))
+            continue
+        if num_splits < 2:
+            raise ValueError('Cannot hold out the run groups of {} \'{}\' with only one group.'.format(by, value))
+        for part in range(num_splits):
+            train, test = ~held_out & (group_parts != part), held_out & (group_parts == part)
+            if test.any():
+                folds.append(Fold(by, value, part, np.flatnonzero(train), np.flatnonzero(test)))
+    return folds
+
+
+def holdout_metrics(y_true, y_pred):
+    ''' Return a dict of regression and ranking metrics based on y_true and y_pred results.
+    '''
+    return {'r2': r2_score(y_true, y_pred), 'mae': mean_absolute_error(y_true, y_pred),
+        'mse': mean_squared_error(y_true, y_pred), **ranking_metrics(y_true, y_pred)}
+
+
+def _fold_matrices(fold, preprocess, cache, key):
+    if cache is not None:
+        matrices = cache.get(key)
+        if matrices is not None:
+            return matrices, True
+
+    X_train, X_test = _rows(_X, fold.train_idx), _rows(_X, fold.test_idx)
+    if preprocess is not None:
+        preprocess = clone(preprocess).fit(X_train)
+        X_train, X_test = preprocess.transform(X_train), preprocess.transform(X_test)
+    if cache is not None:
+        cache.put(key, (X_train, X_test))
+    return (X_train, X_test), False
+
+
+def evaluate_fold(estimator, fold, preprocess, cache, key, threads):
+    ''' Fit a clone of `estimator` on the training rows of `fold` in the worker's
+        data and predict the held out rows. The fold matrices are read from
+        `cache` under `key` or transformed by a clone of `preprocess` fit on the
+        training rows and added to it.
+        Returns:
+            a dict of the fold, its predictions and timings
+    '''
+    (X_train, X_test), cached = _fold_matrices(fold, preprocess, cache, key)
+    estimator = _with_threads(clone(estimator), threads)
+    with threadpool_limits(limits=threads):
+        start = perf_counter()
+        estimator.fit(X_train, _rows(_y, fold.train_idx))
+        fit_seconds = perf_counter() - start
+
+        start = perf_counter()
+        y_pred = estimator.predict(X_test)
+        predict_seconds = perf_counter() - start
+
+    return {'fold': fold, 'y_pred': y_pred, 'fit_seconds': fit_seconds, 'predict_seconds': predict_seconds,
+        'cached': cached}
+
+
+def evaluate_holdout(X, y, index, estimator, by='machine', preprocess=None, cache=None, jobs=1, threads=1,
+    group_splits=DEFAULT_GROUP_SPLITS):
+    ''' How well `estimator` predicts a machine, or an app if `by` is 'app', that
+        it was not trained on. Every value of that level of the row `index` is
+        held out in turn, and a clone of `estimator` is fit on the other rows
+        that are not of a held out run group (see `holdout_folds`). Every held
+        out row is predicted once and the metrics of each value are computed
+        over all of its rows. The transformer `preprocess` is fit on the
+        training rows of each fold.
+        With a `cache.FeatureCache` as `cache`, the transformed fold matrices are
+        cached by the contents of `X` and `y`, the fold and the parameters of
+        `preprocess`, so evaluating other models on the same data skips them.
+        The folds run on a pool of `jobs` processes with `threads` threads each.
+        Returns:
+            a frame with a row of metrics per held out value
+    '''
+    folds = holdout_folds(index, by, group_splits)
+    keys = [None] * len(folds)
+    if cache is not None:
+        data_key = array_hash(np.asarray(X), np.asarray(y))
+        preprocess_key = None if preprocess is None else make_key(type(preprocess).__name__,
+            sorted(preprocess.get_params().items()))
+        keys = [make_key(data_key, preprocess_key, fold.by, fold.held_out, fold.part, len(fold.test_idx))
+            for fold in folds]
+
+    with _executor(X, y, jobs) as executor:
+        results = _run_tasks(executor, evaluate_fold, [(estimator, fold, preprocess, cache, key, threads)
+            for fold, key in zip(folds, keys)])
+
+    rows = []
+    for held_out in dict.fromkeys(fold.held_out for fold in folds):
+        parts = [result for result in results if result['fold'].held_out == held_out]
+        test_idx = np.concatenate([result['fold'].test_idx for result in parts])
+        y_pred = np.concatenate([result['y_pred'] for result in parts])
+        rows.append({'by': by, 'held_out': held_out, 'parts': len(parts),
+            'train_rows': int(np.mean([len(result['fold'].train_idx) for result in parts])),
+            'test_rows': len(test_idx), **holdout_metrics(np.asarray(_rows(y, test_idx)), y_pred),
+            'fit_seconds': sum(result['fit_seconds'] for result in parts),
+            'predict_seconds': sum(result['predict_seconds'] for result in parts),
+            'cached': all(result['cached'] for result in parts)})
+    return pd.DataFrame(rows)
+
+
+def write_leaderboard(leaderboard, fpath, dataset='', scoring=DEFAULT_SCORING):
+    ''' Save `leaderboard` to `fpath` (.csv or .json). Rows already in the file for
+        the same dataset, scoring, model and parameters are replaced, so repeated
+        and partial searches build up one leaderboard. Returns the merged
+        leaderboard.
+    '''
+    ext = splitext(fpath)[1]
+    if ext not in ['.csv', '.json']:
+        raise ValueError('Unsupported leaderboard format \'{}\'. Use .csv or .json.'.format(ext))
+
+    leaderboard = leaderboard.assign(dataset=dataset, scoring=scoring, recorded=time())[LEADERBOARD_COLUMNS]
+    if exists(fpath):
+        previous = pd.read_csv(fpath) if ext == '.csv' else pd.read_json(fpath, orient='records')
+        previous['dataset'] = previous['dataset'].fillna('').astype(str)
+        if 'scoring' not in previous:
+            previous['scoring'] = DEFAULT_SCORING
+        leaderboard = pd.concat([previous, leaderboard], ignore_index=True).drop_duplicates(
+            ['dataset', 'scoring', 'model', 'params'], keep='last')
+    leaderboard = leaderboard.sort_values(['dataset', 'scoring', 'rung', 'mean_score'],
+        ascending=[True, True, False, False], ignore_index=True)[LEADERBOARD_COLUMNS]
+
+    if ext == '.csv':
+        leaderboard.to_csv(fpath, index=False)
+    else:
+        leaderboard.to_json(fpath, orient='records', indent=2)
+    return leaderboard
@@ -3,24 +3,26 @@
 '''
 # std imports
 from argparse import ArgumentParser
+from contextlib import nullcontext
+from os import makedirs
+from tempfile import TemporaryDirectory
+import pickle
 
 # tpl imports
-import numpy as np
 import pandas as pd
-from sklearn.dummy import DummyRegressor
-from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
-from sklearn.linear_model import LinearRegression, Ridge, Lasso, OrthogonalMatchingPursuit
-from sklearn.preprocessing import StandardScaler
 from sklearn.tree import DecisionTreeRegressor
 from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, explained_variance_score
-from sklearn.model_selection import train_test_split, GridSearchCV, cross_validate
-from sklearn.neighbors import KNeighborsRegressor, RadiusNeighborsRegressor
-from sklearn.neural_network import MLPRegressor
-from scipy.stats import rankdata
-from xgboost import XGBRegressor
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
 
 # local imports
-from dataset import get_regression_dataset
+from cache import DEFAULT_FEATURE_CACHE_MB, FeatureCache
+from dataset import get_feature_columns, load_regression_arrays
+from preprocessing import CounterNormalizer
+from ranking import SCORERS, ranking_metrics
+from search import DEFAULT_SCORING, evaluate_holdout, get_candidates, halving_search, \
+    search_models, with_preprocessing, write_leaderboard
+from storage import compact_frame
 
 
 # sklearn forces warnings -- ugh -- this should get rid of them though
@@ -32,53 +34,60 @@ warnings.warn = warn
 
 def get_args():
     parser = ArgumentParser()
-    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset')
+    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset (.csv, .parquet or .feather)')
     parser.add_argument('-t', '--task', type=str, choices=['regression', 'classification'], default='regression',
         help='What training problem to run.')
-    return parser.parse_args()
-
-
-def get_dataset(fpath, task):
-    df = pd.read_csv(fpath)
-
+    parser.add_argument('--compact', action='store_true', help='keep the dataset in memory with compact dtypes')
+    parser.add_argument('--cache', type=str, help='directory to cache built training datasets in')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_FEATURE_CACHE_MB, help='max size of the ' +
+        'cache in MB. Least recently used datasets are evicted')
+    parser.add_argument('--arrays', type=str, help='path prefix of memory-mapped float32 feature and target ' +
+        'files. They are reused while the dataset is unchanged and can be shared by several runs')
+    parser.add_argument('-m', '--models', type=str, nargs='+', choices=[c.name for c in get_candidates()],
+        help='models to search (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='processes that fit models and CV folds')
+    parser.add_argument('--threads', type=int, default=1, help='threads used by each model fit')
+    parser.add_argument('--leaderboard', type=str, help='csv or json leaderboard to merge the search results into')
+    parser.add_argument('--search', type=str, choices=['grid', 'halving'], default='grid', help='cross-validate ' +
+        'every setting or narrow them down by successive halving')
+    parser.add_argument('--budget', type=float, help='seconds a halving search may run before it stops starting fits')
+    parser.add_argument('--resource', type=str, default='n_samples', help='what halving gives more of each rung: ' +
+        'n_samples or a model parameter such as n_estimators')
+    parser.add_argument('--factor', type=int, default=3, help='halving keeps the best 1/factor settings each rung')
+    parser.add_argument('--scoring', type=str, default=DEFAULT_SCORING, help='what the search maximizes: a ' +
+        'sklearn scorer name or a ranking scorer ({})'.format(', '.join(SCORERS)))
+    parser.add_argument('--apps', type=str, nargs='+', help='apps to train on, or \'all\' (default: laghos, or ' +
+        'all with --holdout app)')
+    parser.add_argument('--holdout', type=str, choices=['machine', 'app'], default='machine', help='evaluate the ' +
+        'best model on each machine or app while holding it out of training')
+    parser.add_argument('--save-model', type=str, help='pickle the best model and its fitted preprocessing here')
+    args = parser.parse_args()
+
+    if args.apps is None:
+        args.apps = ['all'] if args.holdout == 'app' else ['laghos']
+    elif args.holdout == 'app' and args.apps != ['all'] and len(set(args.apps)) < 2:
+        parser.error('--holdout app needs several --apps (or \'all\') to hold one out at a time')
+    return args
+
+
+LABEL_COLUMNS = ['quartz Relative Time', 'ruby Relative Time', 'corona Relative Time', 'lassen Relative Time']
+
+
+def get_dataset(fpath, task, compact=False, cache=None, prefix=None, apps=('laghos',)):
+    ''' Returns float32 (X, y, features, labels, index) for `task`. See `dataset.export_arrays`.
+    '''
     if task == 'regression':
-        return get_regression_dataset(df, round_targets=False, include_app=False, run_size='core',
-            include_runtime=None, relative_to='quartz')
+        return load_regression_arrays(fpath, targets=LABEL_COLUMNS, prefix=prefix, cache=cache,
+            transform=compact_frame if compact else None, round_targets=False, include_app=False, run_size='core',
+            include_runtime=None, relative_to='quartz', apps=apps)
     else:
         raise NotImplementedError("training task {} not yet implemented.".format(task))
 
 def split_features_labels(ds):
-    LABEL_COLUMNS = ['quartz Relative Time', 'ruby Relative Time', 'corona Relative Time', 'lassen Relative Time']
-    FEATURE_COLUMNS = list(set(ds.columns) - set(LABEL_COLUMNS))
+    FEATURE_COLUMNS = get_feature_columns(ds, LABEL_COLUMNS)
     return ds[FEATURE_COLUMNS], ds[LABEL_COLUMNS]
 
 
-def normalize(X):
-    ''' normalize data set.
-    '''
-    BY_INST = ['FP_ARITH:SCALAR_DOUBLE', 'PAPI_BR_INS', 'FP_ARITH:SCALAR_SINGLE',
-       'PAPI_SR_INS', 'ARITH', 'PAPI_LD_INS']
-    for col in BY_INST:
-        X[col] = X[col] / X['PAPI_TOT_INS']
-    
-    SCALE_COLS = ['PAPI_L2_LDM', 'PAPI_L2_STM', 'IO Bytes Read', 'IO Bytes Written',
-       'PAPI_MEM_WCY', 'PAPI_L1_LDM', 'PAPI_L1_STM']
-    if 'REALTIME (sec)' in X.columns:
-        SCALE_COLS.append('REALTIME (sec)')
-    if 'Overhead' in X.columns:
-        SCALE_COLS.append('Overhead')
-    X[SCALE_COLS] = StandardScaler().fit_transform(X[SCALE_COLS])
-    return X
-
-
-def same_order_score(y_true, y_pred):
-    ''' Check how many elements share same ordering.
-    '''
-    same_order = lambda x: np.array_equal(rankdata(x[0]), rankdata(x[1]))
-    total_same = sum(map(same_order, zip(y_true, y_pred)))
-    return float(total_same) / y_pred.shape[0]
-
-
 def regression_metrics(y_true, y_pred):
     ''' Return a dict of metrics based on y_true and y_pred results.
     '''
@@ -87,7 +96,7 @@ def regression_metrics(y_true, y_pred):
         'mse': mean_squared_error(y_true, y_pred),
         'mae': mean_absolute_error(y_true, y_pred),
         'evs': explained_variance_score(y_true, y_pred),
-        'sos': same_order_score(y_true, y_pred)
+        **ranking_metrics(y_true, y_pred)
     }
 
 
@@ -102,112 +111,106 @@ def train_tree_regressor(ds):
     clf.fit(X_train, y_train)
     y_pred = clf.predict(X_test)
 
-    same_order_score(y_test, y_pred)
-
     scores = regression_metrics(y_test, y_pred)
     for metric, score in scores.items():
-        print('{:3}: {:.3f}'.format(metric, score))
+        print('{:5}: {:.3f}'.format(metric, score))
 
 
-def get_regressor_best(Regressor, X, y, tune=None, **params):
-    ''' Find an approximate best score from regressor on X and y.
+def print_importances(model, X):
+    ''' Print the feature importances of `model`, or of the model at the end of
+        a pipeline, if it has them.
     '''
-    print('Training regressor \'{}\'...'.format(Regressor.__name__))
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
-    rgrsr = Regressor(**params)
-    best_score = 0
-    scoring = 'neg_mean_absolute_error'
-
-    if tune:
-        search = GridSearchCV(rgrsr, tune, refit=True, scoring=scoring)
-        search.fit(X_train, y_train)
-
-        best_params = search.best_params_
-        best_score = search.best_score_
-        print('{} scores: {}\twith {}'.format(Regressor.__name__, -best_score, best_params))
-        rgrsr = search.best_estimator_
-    else:
-        cv_results = cross_validate(rgrsr, X, y, cv=5, scoring=scoring)
-        scores = cv_results['test_score']
-        best_score = np.mean(scores)
-        print('{} scores: {} +/- {}'.format(Regressor.__name__, -best_score, np.std(scores)))
-
-        rgrsr.fit(X_train, y_train)
-    
-    if hasattr(rgrsr, 'feature_importances_'):
-        if hasattr(rgrsr, 'feature_names_in_'):
-            importances = sorted(zip(rgrsr.feature_names_in_, rgrsr.feature_importances_), key=lambda x: x[1], reverse=True)
-            print('Feature Importances: {}'.format(importances))
-        else:
-            importances = sorted(zip(X.columns.tolist(), rgrsr.feature_importances_), key=lambda x: x[1], reverse=True)
-            print('Feature Importances: {}'.format(importances))
-
-    return rgrsr, best_score
-
-
-def find_best_regressor(ds):
-    ''' Try a large number of regressors and present the best one.
+    # the pipeline's preprocessing keeps the columns, so they have the pipeline's names
+    names = model.feature_names_in_ if hasattr(model, 'feature_names_in_') else X.columns.tolist()
+    if isinstance(model, Pipeline):
+        model = model[-1]
+    if hasattr(model, 'feature_importances_'):
+        importances = sorted(zip(names, model.feature_importances_), key=lambda x: x[1], reverse=True)
+        print('Feature Importances: {}'.format(importances))
+
+
+def run_search(X, y, candidates, search='grid', scoring=DEFAULT_SCORING, jobs=1, threads=1, **halving):
+    ''' `search_models` or, if `search` is 'halving', `halving_search` with the
+        `halving` options (budget, resource, factor).
     '''
-    X, y = split_features_labels(ds)
-    X.reset_index(inplace=True, drop=True)
-    y_orig = y
-    y = y.reset_index(drop=True).to_numpy()
-    X = normalize(X)
-    models = []
-    #print(X, y)
-
-    #tune_params = {'fit_intercept': [True, False]}
-    #result = get_regressor_best(LinearRegression, X, y, tune=tune_params)
-    #models.append(result)
-
-    #tune_params = {'max_depth': [1, 2, 4, 8, 12], 'criterion': ['mae', 'mse']}
-    #result = get_regressor_best(DecisionTreeRegressor, X, y, tune=tune_params)
-    #models.append(result)
-
-    #tune_params = {'n_estimators': [10, 50, 100], 'criterion': ['mse', 'mae', 'poisson']}
-    #result = get_regressor_best(RandomForestRegressor, X, y, tune=tune_params)
-    #models.append(result)
-
-    #tune_params = {'n_estimators': [10, 50, 100], 'criterion': ['mse', 'mae', 'poisson']}
-    #result = get_regressor_best(ExtraTreesRegressor, X, y, tune=tune_params)
-    #models.append(result)
-
-    tune_params = {'n_estimators': [1,2,10,50,100], 'eta': [0.3, 0.1],
-        'booster': ['gbtree', 'gblinear', 'dart']}
-    result = get_regressor_best(XGBRegressor, X, y, tune=tune_params)
-    models.append(result)
-
-    #result = get_regressor_best(DummyRegressor, X, y, strategy='mean')
-    #models.append(result)
-
-    #result = get_regressor_best(DummyRegressor, X, y, strategy='median')
-    #models.append(result)
-
-    best_model, best_score = max(models, key=lambda x: x[1])
-    print('\nSelecting \'{}\' as best model with score: {}'.format(best_model.__class__.__name__, -best_score))
-    #_, X_test, _, y_test = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
-    X_test, y_test = X[X['corona'] == 1], y_orig.loc[:,:,:,'corona'].to_numpy()
-    y_true, y_pred = y_test, best_model.predict(X_test)
-    scores = regression_metrics(y_true, y_pred)
-    for metric, score in scores.items():
-        print('{:3}: {:.3f}'.format(metric, score))
-
-    print('\nExample Outputs:')
-    print('Actual\t\t\tPredicted')
-    print('------\t\t\t--------')
-    LIM = 5
-    for tr, pr in zip(y_true[:LIM], y_pred[:LIM]):
-        tr_list, pr_list = ['{}'.format(x) for x in tr], ['{:0.4f}'.format(x) for x in pr]
-        print('{} -> {}'.format(str(tr_list), str(pr_list)))
+    if search == 'halving':
+        return halving_search(X, y, candidates, scoring=scoring, jobs=jobs, threads=threads, **halving)
+    return search_models(X, y, candidates, scoring=scoring, jobs=jobs, threads=threads)
+
+
+def display_score(score, scoring):
+    ''' `score` as an error if `scoring` is a negated error, else unchanged. '''
+    return -score if scoring.startswith('neg_') else score
+
+
+def find_best_regressor(X, y, features, index, models=None, jobs=1, threads=1, leaderboard=None, dataset='',
+    search='grid', scoring=DEFAULT_SCORING, holdout='machine', cache=None, save_model=None, **halving):
+    ''' Search a large number of regressors in parallel and present the best one.
+        `X` and `y` are float32 matrices and `X` has a column for each of
+        `features`. `models` limits the search to those names in
+        `search.get_candidates`. The leaderboard of every model and parameter
+        setting is printed and merged into the file `leaderboard` if given.
+        `search`, `scoring` and `halving` are passed to `run_search`. Every
+        model is a pipeline that starts with a `CounterNormalizer` fit on its
+        training rows. With a `cache`, fitted normalizers are shared by the
+        parameter settings of this search through a temporary directory in the
+        cache directory, which is removed when the search is done. The best pipeline is pickled to `save_model` if
+        given. It is then evaluated with each `holdout` value ('machine' or
+        'app') of the row `index` held out in turn and its fold matrices are
+        kept in `cache`.
+    '''
+    # the frame wraps X without copying it and gives the models feature names
+    X = pd.DataFrame(X, columns=features, copy=False)
+    X_train, _, y_train, _ = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
+
+    if cache is not None:
+        makedirs(cache.cachedir, exist_ok=True)
+    with nullcontext() if cache is None else TemporaryDirectory(dir=cache.cachedir) as memory:
+        candidates = with_preprocessing(get_candidates(models), CounterNormalizer(), memory=memory)
+        print('Searching {} models with {} processes of {} threads...'.format(len(candidates), jobs, threads))
+        result = run_search(X_train, y_train, candidates, search=search, scoring=scoring, jobs=jobs,
+            threads=threads, **halving)
+
+    with pd.option_context('display.max_colwidth', 60, 'display.width', 200):
+        print(result.leaderboard.drop(columns=['threads']).to_string(index=False))
+    if leaderboard:
+        write_leaderboard(result.leaderboard, leaderboard, dataset=dataset, scoring=scoring)
+        print('Wrote leaderboard to \'{}\'.'.format(leaderboard))
+
+    best_name = max(result.best, key=lambda name: result.best[name][1])
+    best_model, best_score, _ = result.best[best_name]
+    # the search's transformer cache is gone
+    best_model.set_params(memory=None)
+    print_importances(best_model, X)
+    print('\nSelecting \'{}\' as best model with score: {}'.format(best_name, display_score(best_score, scoring)))
+    if save_model:
+        with open(save_model, 'wb') as fp:
+            pickle.dump(best_model, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        print('Wrote \'{}\' with its fitted preprocessing to \'{}\'.'.format(best_name, save_model))
+
+    print('\nEvaluating \'{}\' with one {} held out at a time. Its parameters were chosen by a search over '
+        'every {}, so the scores are optimistic...'.format(best_name, holdout, holdout))
+    folds = evaluate_holdout(X, y, index, best_model.named_steps['model'], by=holdout,
+        preprocess=best_model.named_steps['preprocess'], cache=cache, jobs=jobs, threads=threads)
+    with pd.option_context('display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(folds.drop(columns=['by']).to_string(index=False))
+    metrics = folds.columns[folds.columns.get_loc('test_rows') + 1:folds.columns.get_loc('fit_seconds')]
+    print('Mean over {} held out {}s: {}'.format(len(folds), holdout, ', '.join('{}: {:.3f}'.format(metric,
+        folds[metric].mean()) for metric in metrics)))
 
     
 def main():
     args = get_args()
 
-    ds = get_dataset(args.dataset, args.task)
-    ds.dropna(inplace=True)
+    cache = FeatureCache(args.cache, max_mb=args.cache_size) if args.cache else None
+    X, y, features, _, index = get_dataset(args.dataset, args.task, compact=args.compact, cache=cache,
+        prefix=args.arrays, apps=None if args.apps == ['all'] else tuple(args.apps))
     
-    find_best_regressor(ds)
+    halving = {'budget': args.budget, 'resource': args.resource, 'factor': args.factor} \
+        if args.search == 'halving' else {}
+    find_best_regressor(X, y, features, index, models=args.models, jobs=args.jobs, threads=args.threads,
+        leaderboard=args.leaderboard, dataset=args.dataset, search=args.search, scoring=args.scoring,
+        holdout=args.holdout, cache=cache, save_model=args.save_model, **halving)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,396 @@
+''' Reading and writing datasets. Datasets can be stored as csv or in a columnar
+    format (parquet or feather) chosen by the file extension. Columnar files are
+    written with an explicit schema, so every stage of the pipeline reads back the
+    same types without any text parsing. A path without an extension is a
+    directory of parquet files partitioned by machine and app, which
+    `LazyDataset` can query reading only the partitions and columns it needs.
+'''
+# std imports
+from ast import literal_eval
+from csv import QUOTE_NONNUMERIC
+from os.path import splitext
+
+# tpl imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from normalization import DEFAULT_RULES
+
+
+COLUMNAR_EXTENSIONS = ['.parquet', '.feather']
+DATASET_EXTENSIONS = COLUMNAR_EXTENSIONS + ['.csv']
+
+# columns with a fixed type; all remaining numeric columns are float64 counters
+CATEGORICAL_COLUMNS = ['machine', 'app', 'args']
+STRING_COLUMNS = ['exec', 'modules', 'spack_env', 'exec_path', 'events']
+INTEGER_COLUMNS = ['ranks']
+LIST_COLUMNS = ['path']
+
+# columns a partitioned dataset directory is split on, as "<col>=<value>" subdirectories
+PARTITION_COLUMNS = ['machine', 'app']
+
+
+def _as_list(val):
+    ''' csv datasets store lists as their Python string representation '''
+    if isinstance(val, str):
+        return literal_eval(val) if val.startswith('[') else [val]
+    return list(val)
+
+
+def _to_csv(df, fpath, **kwargs):
+    ''' Write `df` as csv. List columns read from columnar files hold arrays, which
+        are written as Python lists so csv datasets look the same either way.
+    '''
+    df = expand_dataset(df)
+    list_columns = [col for col in LIST_COLUMNS if col in df.columns]
+    if list_columns:
+        df = df.assign(**{col: df[col].map(lambda val: val if isinstance(val, str) else list(val))
+            for col in list_columns})
+    df.to_csv(fpath, index=False, quoting=QUOTE_NONNUMERIC, **kwargs)
+
+
+def pandas_dtype(col, numeric):
+    ''' The pandas dtype of dataset column `col`. Columns without a fixed type are
+        float64 counters if `numeric`. Returns None for the list columns, which
+        have no pandas dtype, and for other non-numeric columns.
+    '''
+    if col in CATEGORICAL_COLUMNS:
+        return 'category'
+    elif col in STRING_COLUMNS:
+        return 'str'
+    elif col in INTEGER_COLUMNS:
+        return 'int64'
+    elif col in LIST_COLUMNS:
+        return None
+    return 'float64' if numeric else None
+
+
+def apply_dtypes(df):
+    ''' Cast the columns of `df` in-place to their dataset dtypes, so frames from
+        different files can be concatenated without upcasting.
+    '''
+    dtypes = {col: pandas_dtype(col, pd.api.types.is_numeric_dtype(df[col])) for col in df.columns}
+    dtypes = {col: dtype for col, dtype in dtypes.items() if dtype is not None and df[col].dtype != dtype}
+    for col, dtype in dtypes.items():
+        df[col] = df[col].astype(dtype)
+
+
+def unify_categories(dataframes):
+    ''' Give every categorical column the same categories in all of `dataframes`,
+        so that `pd.concat` keeps them categorical instead of falling back to
+        object. Changes the frames in-place.
+    '''
+    for col in CATEGORICAL_COLUMNS:
+        frames = [df for df in dataframes if col in df.columns]
+        categories = pd.Index([])
+        for df in frames:
+            categories = categories.union(df[col].cat.categories)
+        for df in frames:
+            df[col] = df[col].cat.set_categories(categories)
+
+
+def memory_usage_mb(df):
+    ''' Memory used by `df` in MB, including the Python strings it holds.
+    '''
+    return df.memory_usage(index=True, deep=True).sum() / (1024.0 * 1024.0)
+
+
+def _smallest_int(lo, hi):
+    for dtype in ['int8', 'int16', 'int32', 'int64']:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return None
+
+
+def _compact_numeric(series, fill):
+    ''' The smallest integer or float dtype that holds `series` exactly. `fill`
+        values are masked, giving a nullable column if there are any. NaNs are
+        kept apart from them as float NaNs. Without a `fill`, NaNs are masked.
+    '''
+    values = series.to_numpy(dtype='float64')
+    mask = np.isnan(values) if fill is None else (values == fill)
+    present = values[~mask]
+
+    dtype = None
+    if present.size == 0:
+        dtype = 'int8'
+    elif np.array_equal(np.floor(present), present):
+        dtype = _smallest_int(present.min(), present.max())
+    if dtype is None:
+        dtype = 'float32' if np.array_equal(present.astype('float32'), present, equal_nan=True) else 'float64'
+
+    if not mask.any():
+        return pd.Series(values.astype(dtype), index=series.index)
+    values = np.where(mask, 0, values).astype(dtype)
+    if dtype.startswith('int'):
+        array = pd.arrays.IntegerArray(values, mask)
+    else:
+        array = pd.arrays.FloatingArray(values, mask)
+    return pd.Series(array, index=series.index)
+
+
+def compact_dataset(df, fill=DEFAULT_RULES['fill']):
+    ''' A copy of `df` that uses far less memory. Repeated strings become
+        categoricals and numeric columns take the smallest integer or float type
+        that holds them exactly. Counters that are `fill`, which normalization
+        sets for counters a system cannot measure, become masked <NA> values,
+        while NaN counters stay NaN. The list column 'path' is unique per run and
+        is kept as-is. `expand_dataset` reverses this.
+    '''
+    columns = {}
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS or col in STRING_COLUMNS:
+            columns[col] = df[col].astype('category')
+        elif col in INTEGER_COLUMNS:
+            columns[col] = _compact_numeric(df[col], None)
+        elif col not in LIST_COLUMNS and pd.api.types.is_numeric_dtype(df[col]):
+            columns[col] = _compact_numeric(df[col], fill)
+    return df.assign(**columns)
+
+
+def compact_frame(df):
+    ''' `compact_dataset(df)` that prints the memory use before and after. Used as
+        the `transform` of the model scripts' `--compact` datasets.
+    '''
+    before = memory_usage_mb(df)
+    df = compact_dataset(df)
+    print('Compacted dataset from {:.2f} MB to {:.2f} MB.'.format(before, memory_usage_mb(df)))
+    return df
+
+
+def expand_dataset(df, fill=DEFAULT_RULES['fill']):
+    ''' Inverse of `compact_dataset`. Masked counters are set back to `fill`, NaN
+        counters stay NaN and every column gets its dataset dtype. Frames that are
+        not compact are returned unchanged.
+    '''
+    columns = {}
+    for col in df.columns:
+        dtype = pandas_dtype(col, pd.api.types.is_numeric_dtype(df[col]))
+        if dtype is None or df[col].dtype == dtype:
+            continue
+        if dtype in ['int64', 'float64'] and pd.api.types.is_extension_array_dtype(df[col]):
+            # only the masked positions get `fill`; float NaNs are not masked
+            values = df[col].to_numpy(dtype='float64', na_value=fill)
+            columns[col] = pd.Series(values, index=df.index).astype(dtype)
+        else:
+            columns[col] = df[col].astype(dtype)
+    return df.assign(**columns) if columns else df
+
+
+def fill_masked(df, fill=DEFAULT_RULES['fill']):
+    ''' `df` with the masked counters of a compact dataset set back to `fill`,
+        keeping their compact dtypes. Unlike `expand_dataset`, the frame stays
+        compact while features are built from it.
+    '''
+    columns = {}
+    for col in df.columns:
+        if (col not in INTEGER_COLUMNS and pd.api.types.is_numeric_dtype(df[col]) and
+            pd.api.types.is_extension_array_dtype(df[col])):
+            # -1 fits every signed integer and float dtype compact_dataset picks
+            columns[col] = pd.Series(df[col].to_numpy(dtype=df[col].dtype.numpy_dtype, na_value=fill),
+                index=df.index)
+    return df.assign(**columns) if columns else df
+
+
+def arrow_schema(df):
+    ''' The arrow schema a dataset with the columns of `df` is stored with.
+    '''
+    import pyarrow as pa
+
+    fields = []
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            dtype = pa.dictionary(pa.int32(), pa.string())
+        elif col in STRING_COLUMNS:
+            dtype = pa.string()
+        elif col in INTEGER_COLUMNS:
+            dtype = pa.int64()
+        elif col in LIST_COLUMNS:
+            dtype = pa.list_(pa.string())
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            dtype = pa.float64()
+        else:
+            dtype = pa.string()
+        fields.append(pa.field(col, dtype))
+    return pa.schema(fields)
+
+
+def to_arrow_table(df):
+    ''' Convert `df` to an arrow table with the dataset schema.
+    '''
+    import pyarrow as pa
+
+    df = expand_dataset(df).copy()
+    for col in LIST_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].map(_as_list)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(str).astype('category')
+    return pa.Table.from_pandas(df, schema=arrow_schema(df), preserve_index=False)
+
+
+def write_dataset(df, fpath):
+    ''' Write `df` to `fpath` in the format given by its extension. A path with no
+        extension is written as a partitioned directory.
+    '''
+    ext = splitext(fpath)[1]
+    if ext == '':
+        import pyarrow.parquet as pq
+        pq.write_to_dataset(to_arrow_table(df), fpath, partition_cols=PARTITION_COLUMNS,
+            existing_data_behavior='delete_matching')
+    elif ext == '.csv':
+        _to_csv(df, fpath)
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(to_arrow_table(df), fpath)
+    elif ext == '.feather':
+        import pyarrow.feather as feather
+        feather.write_feather(to_arrow_table(df), fpath)
+    else:
+        raise ValueError('Unsupported dataset format \'{}\'. Use one of {}.'.format(ext, DATASET_EXTENSIONS))
+
+
+class DatasetWriter:
+    ''' Write a dataset to `fpath` one chunk of rows at a time. Only csv and
+        parquet can be appended to. Use as a context manager.
+    '''
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.ext = splitext(fpath)[1]
+        if self.ext not in ['.csv', '.parquet']:
+            raise ValueError('Cannot write dataset format \'{}\' in chunks. Use .csv or .parquet.'.format(self.ext))
+        self.parquet_writer, self.schema = None, None
+        self.num_chunks = 0
+
+    def write(self, df):
+        if self.ext == '.csv':
+            _to_csv(df, self.fpath, mode='a' if self.num_chunks else 'w', header=(self.num_chunks == 0))
+        else:
+            import pyarrow.parquet as pq
+            table = to_arrow_table(df)
+            if self.parquet_writer is None:
+                self.schema = table.schema
+                self.parquet_writer = pq.ParquetWriter(self.fpath, self.schema)
+            self.parquet_writer.write_table(table.cast(self.schema))
+        self.num_chunks += 1
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_dataset(fpath, columns=None):
+    ''' Read the dataset at `fpath`. Columnar files are converted to pandas without
+        re-parsing and csv files are parsed with the dataset dtypes rather than
+        inferring them; `columns` limits what is read.
+    '''
+    ext = splitext(fpath)[1]
+    if ext == '':
+        return LazyDataset(fpath, columns=columns).collect()
+    elif ext == '.csv':
+        header = pd.read_csv(fpath, nrows=0).columns
+        dtypes = {col: pandas_dtype(col, numeric=False) for col in header}
+        df = pd.read_csv(fpath, usecols=columns, dtype={col: dtype for col, dtype in dtypes.items() if dtype})
+        apply_dtypes(df)
+        return df
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(fpath, columns=columns)
+    elif ext == '.feather':
+        import pyarrow.feather as feather
+        table = feather.read_table(fpath, columns=columns)
+    else:
+        raise ValueError('Unsupported dataset format \'{}\'. Use one of {}.'.format(ext, DATASET_EXTENSIONS))
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+class LazyDataset:
+    ''' A query over the dataset at `fpath` that is only run by `collect`. Filters
+        and column selections are pushed down to pyarrow, so a partitioned
+        directory only reads the matching machine and app partitions and
+        parquet files skip row groups whose statistics do not match. csv
+        datasets are read whole and filtered in pandas.
+    '''
+
+    def __init__(self, fpath, filters=None, columns=None):
+        self.fpath = fpath
+        self.filters = filters or {}
+        self.columns = columns
+
+    def filter(self, **conditions):
+        ''' Only keep rows where each column is the given value, or one of the
+            values if a list is given, e.g. `filter(app='laghos', ranks=1)`.
+        '''
+        conditions = {col: list(vals) if isinstance(vals, (list, tuple, set)) else [vals]
+            for col, vals in conditions.items()}
+        filters = dict(self.filters)
+        for col, vals in conditions.items():
+            filters[col] = [val for val in filters[col] if val in vals] if col in filters else vals
+        return LazyDataset(self.fpath, filters=filters, columns=self.columns)
+
+    def select(self, columns):
+        ''' Only read `columns`. '''
+        return LazyDataset(self.fpath, filters=self.filters, columns=list(columns))
+
+    def _arrow_dataset(self):
+        import pyarrow.dataset as ds
+
+        ext = splitext(self.fpath)[1]
+        if ext == '':
+            return ds.dataset(self.fpath, format='parquet',
+                partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+        return ds.dataset(self.fpath, format='parquet' if ext == '.parquet' else 'feather')
+
+    def schema_columns(self):
+        ''' Names of all the columns in the dataset, read from its metadata only.
+        '''
+        if splitext(self.fpath)[1] == '.csv':
+            return list(pd.read_csv(self.fpath, nrows=0).columns)
+        return _dataset_column_order(self._arrow_dataset().schema.names)
+
+    def collect(self):
+        ''' Run the query and return it as a frame. '''
+        ext = splitext(self.fpath)[1]
+        if ext not in DATASET_EXTENSIONS + ['']:
+            raise ValueError('Unsupported dataset format \'{}\'. Use one of {}.'.format(ext, DATASET_EXTENSIONS))
+
+        if ext == '.csv':
+            df = read_dataset(self.fpath)
+            for col, vals in self.filters.items():
+                df = df[df[col].isin(vals)]
+            return df.reset_index(drop=True)[self.columns] if self.columns else df.reset_index(drop=True)
+
+        import pyarrow.compute as pc
+
+        expression = None
+        for col, vals in self.filters.items():
+            condition = pc.field(col).isin(vals)
+            expression = condition if expression is None else expression & condition
+
+        dataset = self._arrow_dataset()
+        columns = self.columns or _dataset_column_order(dataset.schema.names)
+        table = dataset.to_table(columns=columns, filter=expression)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _dataset_column_order(names):
+    ''' Partitioned directories put the partition columns last. They are the first
+        columns of a dataset, so move them back to the front.
+    '''
+    partitions = [col for col in PARTITION_COLUMNS if col in names]
+    return partitions + [col for col in names if col not in partitions]
+
+
+def scan_dataset(fpath):
+    ''' A LazyDataset over all of the dataset at `fpath`. '''
+    return LazyDataset(fpath)
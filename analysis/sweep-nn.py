@@ -0,0 +1,183 @@
+''' Sweep architectures and learning rates of the dense network. The dataset is
+    loaded, split and normalized once and its tensors are put in shared memory,
+    so worker processes train many configurations concurrently without copies.
+    Configurations whose validation loss stops improving, or falls behind the
+    other configurations, are stopped early.
+'''
+# std imports
+from argparse import ArgumentParser
+from itertools import product
+from math import isfinite
+from os import cpu_count
+from os.path import splitext
+from time import perf_counter
+
+# tpl imports
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+# local imports
+from cache import DEFAULT_FEATURE_CACHE_MB, FeatureCache
+from dataset import load_regression_arrays
+from network import TARGETS, THROUGHPUT_BATCH_SIZE, EarlyStopping, Net, predict, regression_metrics, split_tensors, \
+    train_regression
+from ranking import METRICS
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--dataset', type=str, required=True, help='input dataset (.csv, .parquet or .feather)')
+    parser.add_argument('--hidden-sizes', type=str, nargs='+', default=['64', '128', '128,64', '256,128'],
+        help='architectures to try, each a comma separated list of hidden layer sizes')
+    parser.add_argument('--learning-rates', type=float, nargs='+', default=[1e-3, 1e-2], help='learning rates to try')
+    parser.add_argument('--batch-size', type=int, default=THROUGHPUT_BATCH_SIZE, help='training batch size')
+    parser.add_argument('--epochs', type=int, default=100, help='max # of training epochs of a configuration')
+    parser.add_argument('--patience', type=int, default=10, help='epochs without a better validation loss after ' +
+        'which a configuration stops')
+    parser.add_argument('--grace', type=int, default=5, help='epochs before a configuration can be stopped for ' +
+        'being worse than the median of the others')
+    parser.add_argument('--val-size', type=float, default=0.2, help='fraction of samples used for validation')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the split, initial weights and batching')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(), help='configurations trained at once')
+    parser.add_argument('--threads', type=int, help='torch threads of each worker (default: cores / jobs)')
+    parser.add_argument('-o', '--output', type=str, help='csv or json file to write the ranked results to')
+    parser.add_argument('--cache', type=str, help='directory to cache built training datasets in')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_FEATURE_CACHE_MB, help='max size of the ' +
+        'cache in MB. Least recently used datasets are evicted')
+    parser.add_argument('--arrays', type=str, help='path prefix of memory-mapped float32 feature and target files')
+    args = parser.parse_args()
+    if not 0 < args.val_size < 1:
+        parser.error('--val-size must be between 0 and 1, as every configuration is scored on the validation split')
+    return args
+
+
+# shared tensors and settings of a worker process, set once by `_init_worker`
+_data, _history = None, None
+
+
+def _init_worker(data, history, threads):
+    global _data, _history
+    _data, _history = data, history
+    torch.set_num_threads(threads)
+
+
+def _median_best(epoch, config_id):
+    ''' Median over the other configurations that reached `epoch` of the best
+        validation loss they had by then, or None if there are none yet.
+    '''
+    bests = [min(losses[:epoch + 1]) for other, losses in _history.items() if other != config_id and
+        len(losses) > epoch]
+    return float(pd.Series(bests).median()) if bests else None
+
+
+def _nan_scores():
+    return dict.fromkeys(['r2', 'mse', 'mae', 'evs', *METRICS], float('nan'))
+
+
+def _train_config(config_id, hidden_sizes, learning_rate, batch_size, epochs, patience, grace, seed):
+    X_train, y_train, X_val, y_val = _data
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    model = Net(hidden_sizes, num_outputs=y_train.shape[1])
+    losses, state, stopper = [], {'status': 'finished'}, EarlyStopping(patience)
+
+    def on_epoch(epoch, loss):
+        val_loss = (predict(model, X_val) - y_val).abs().mean().item()
+        if not isfinite(val_loss):
+            # a diverged configuration only counts as infinitely bad for the median
+            losses.append(float('inf'))
+            _history[config_id] = losses
+            state['status'] = 'diverged'
+            return True
+        losses.append(val_loss)
+        _history[config_id] = losses
+        if stopper.step(epoch, val_loss, model):
+            state['status'] = 'converged'
+            return True
+
+        median = _median_best(epoch, config_id)
+        if epoch >= grace and median is not None and min(losses) > median:
+            state['status'] = 'pruned'
+            return True
+        return False
+
+    start = perf_counter()
+    train_regression(X_train, y_train, model, learning_rate=learning_rate, epochs=epochs, batch_size=batch_size,
+        in_memory=True, generator=generator, on_epoch=on_epoch, verbose=False)
+    seconds = perf_counter() - start
+
+    scores = _nan_scores()
+    if stopper.best_weights is not None:
+        model.load_state_dict(stopper.best_weights)
+        scores = regression_metrics(y_val.numpy(), predict(model, X_val).numpy())
+    best_loss = stopper.best_loss if isfinite(stopper.best_loss) else float('nan')
+    return {'status': state['status'], 'epochs': len(losses), 'best_epoch': stopper.best_epoch,
+        'val_loss': best_loss, **scores, 'train_seconds': seconds, 'seconds_per_epoch': seconds / len(losses)}
+
+
+def train_config(config_id, hidden_sizes, learning_rate, batch_size, epochs, patience, grace, seed):
+    ''' Train one configuration on the shared data of the worker. After every
+        epoch the validation loss is recorded in the shared history. Training
+        stops after `patience` epochs without improvement, as soon as the loss
+        is not finite, or once past `grace` epochs if the best loss so far is
+        worse than the median of the others at the same epoch. The weights of
+        the best epoch are scored. A configuration that fails or never has a
+        finite loss gets NaN metrics, so the rest of the sweep is kept.
+        Returns:
+            a dict with the configuration, its status, metrics and training time
+    '''
+    config = {'hidden_sizes': ','.join(str(size) for size in hidden_sizes), 'learning_rate': learning_rate}
+    start = perf_counter()
+    try:
+        return {**config, **_train_config(config_id, hidden_sizes, learning_rate, batch_size, epochs, patience,
+            grace, seed), 'error': ''}
+    except Exception as err:
+        _history[config_id] = []
+        return {**config, 'status': 'failed', 'epochs': 0, 'best_epoch': -1, 'val_loss': float('nan'),
+            **_nan_scores(), 'train_seconds': perf_counter() - start, 'seconds_per_epoch': float('nan'),
+            'error': '{}: {}'.format(type(err).__name__, err)}
+
+
+def main():
+    args = get_args()
+
+    start = perf_counter()
+    cache = FeatureCache(args.cache, max_mb=args.cache_size) if args.cache else None
+    X, y, features, _, _ = load_regression_arrays(args.dataset, targets=TARGETS, prefix=args.arrays, cache=cache,
+        relative_to='min', include_app=False, run_size='core', round_targets=False, include_runtime='both')
+    generator = torch.Generator().manual_seed(args.seed)
+    data = tuple(tensor.share_memory_() for tensor in
+        split_tensors(X, y, features, args.val_size, generator)[:4])
+    print('Prepared {:,} training and {:,} validation samples in {:.3f}s.'.format(len(data[0]), len(data[2]),
+        perf_counter() - start))
+
+    configs = [([int(size) for size in sizes.split(',')], lr) for sizes, lr in
+        product(args.hidden_sizes, args.learning_rates)]
+    threads = args.threads or max(1, cpu_count() // args.jobs)
+    print('Training {} configurations with {} processes of {} threads...'.format(len(configs), args.jobs, threads))
+
+    start = perf_counter()
+    ctx = mp.get_context('spawn')
+    with ctx.Manager() as manager:
+        history = manager.dict()
+        with ctx.Pool(args.jobs, initializer=_init_worker, initargs=(data, history, threads)) as pool:
+            results = pool.starmap(train_config, [(idx, sizes, lr, args.batch_size, args.epochs, args.patience,
+                args.grace, args.seed) for idx, (sizes, lr) in enumerate(configs)], chunksize=1)
+
+    results = pd.DataFrame(results).sort_values('val_loss', ignore_index=True, na_position='last')
+    results.index += 1
+    print('Swept {} configurations in {:.3f}s.'.format(len(configs), perf_counter() - start))
+    with pd.option_context('display.width', 200, 'display.float_format', '{:.4f}'.format):
+        print(results.to_string())
+
+    if args.output:
+        if splitext(args.output)[1] == '.json':
+            results.to_json(args.output, orient='records', indent=2)
+        else:
+            results.to_csv(args.output, index_label='rank')
+        print('Wrote results to \'{}\'.'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
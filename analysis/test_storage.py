@@ -0,0 +1,55 @@
+''' Tests of the compact in-memory form of datasets. Run with `python -m pytest`
+    from the analysis directory.
+'''
+# tpl imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from storage import apply_dtypes, compact_dataset, expand_dataset, fill_masked
+
+
+def _dataset():
+    df = pd.DataFrame({
+        'machine': ['quartz', 'ruby', 'quartz', 'ruby'],
+        'app': ['laghos'] * 4,
+        'args': ['-p 1', '-p 1', '-p 2', '-p 2'],
+        'exec': ['laghos'] * 4,
+        'ranks': [1, 1, 36, 36],
+        'path': [['a'], ['b'], ['c'], ['d']],
+        'PAPI_TOT_INS': [1e6, 2e6, 3e6, 4e6],
+        'PAPI_L1_LDM': [10.0, np.nan, -1.0, 20.0],
+        'PAPI_MEM_WCY': [-1.0, -1.0, -1.0, -1.0],
+        'REALTIME (sec)': [1.25, 2.5, 0.1, np.nan],
+    })
+    apply_dtypes(df)
+    return df
+
+
+def test_compact_round_trip():
+    df = _dataset()
+    expanded = expand_dataset(compact_dataset(df))
+    assert list(expanded.dtypes) == list(df.dtypes)
+    pd.testing.assert_frame_equal(expanded, df)
+
+
+def test_compact_keeps_nan_apart_from_fill():
+    compact = compact_dataset(_dataset())
+    assert compact['PAPI_L1_LDM'].isna().tolist() == [False, False, True, False]
+    assert np.isnan(compact['PAPI_L1_LDM'].to_numpy(dtype='float64', na_value=0.0)[1])
+
+    expanded = expand_dataset(compact)
+    assert expanded['PAPI_L1_LDM'].isna().tolist() == [False, True, False, False]
+    assert expanded['PAPI_MEM_WCY'].tolist() == [-1.0] * 4
+    # a NaN counter is still dropped as a missing column by the model datasets
+    assert 'PAPI_L1_LDM' not in expanded.dropna(axis=1).columns
+
+
+def test_fill_masked_keeps_compact_dtypes():
+    df = _dataset()
+    compact = compact_dataset(df)
+    filled = fill_masked(compact)
+    assert filled['PAPI_MEM_WCY'].dtype == 'int8'
+    assert filled['PAPI_MEM_WCY'].tolist() == [-1] * 4
+    assert filled['PAPI_L1_LDM'].dtype == 'float32'
+    np.testing.assert_array_equal(filled['PAPI_L1_LDM'].to_numpy(), df['PAPI_L1_LDM'].to_numpy())